@@ -0,0 +1,170 @@
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from workspaces import atomic_output
+
+# Leaflet draws 256 px tiles; zoom z spans 256 * 2**z pixels around the globe
+TILE_SIZE = 256
+
+# Server-side binning kicks in automatically above this many heat points
+HEAT_GRID_THRESHOLD = 5000
+HEAT_GRID_MODES = ('auto', 'on', 'off')
+
+# Zoom levels precomputed for the /api/heat pyramid; 18 is Leaflet's default max zoom
+PYRAMID_MIN_ZOOM = 0
+PYRAMID_MAX_ZOOM = 18
+
+# Loaded pyramids per process, keyed by path and reloaded when the file changes;
+# the least recently used are dropped once they hold more than this many bytes
+DEFAULT_PYRAMID_CACHE_BYTES = 64 * 1024 * 1024
+PYRAMID_CACHE_BYTES = int(os.environ.get('ONCOCONTOUR_PYRAMID_CACHE_BYTES', DEFAULT_PYRAMID_CACHE_BYTES))
+_pyramids = OrderedDict()
+_pyramids_size = 0
+_pyramids_lock = threading.Lock()
+
+def cell_size_for_zoom(zoom, radius):
+    """Return the width in degrees of longitude of one heat cell at a zoom level
+
+    Leaflet.heat sums points into square cells of radius / 2 pixels before
+    drawing, so pre-binning at that size leaves the rendered layer unchanged
+    up to this zoom level.
+    """
+    return 360.0 / (TILE_SIZE * 2 ** zoom) * (radius / 2)
+
+def aggregate_grid(lat, lng, weights, cell_size):
+    """Sum weighted points into a lat/lng grid and return the non-empty cells
+
+    cell_size is in degrees of longitude; rows are shortened by the cosine of
+    the mean latitude so cells stay square on a Web Mercator map. Each cell is
+    placed at the mean position of its points, so isolated points do not move.
+    Returns (lat, lng, weight) arrays with one entry per occupied cell.
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lng = np.asarray(lng, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    if lat.size == 0:
+        return lat, lng, weights
+
+    inverse, cell_lat, cell_lng = _grid_cells(lat, lng, cell_size)
+    return cell_lat, cell_lng, np.bincount(inverse, weights=weights)
+
+def _grid_cells(lat, lng, cell_size):
+    """Assign points to grid cells; returns each point's cell and the cell positions"""
+    lat_size = cell_size * max(np.cos(np.radians(lat.mean())), 0.01)
+    rows = np.floor((lat - lat.min()) / lat_size).astype(np.int64)
+    cols = np.floor((lng - lng.min()) / cell_size).astype(np.int64)
+    cells = rows * (cols.max() + 1) + cols
+
+    _, inverse = np.unique(cells, return_inverse=True)
+    inverse = inverse.ravel()
+    counts = np.bincount(inverse)
+    return (
+        inverse,
+        np.round(np.bincount(inverse, weights=lat) / counts, 5),
+        np.round(np.bincount(inverse, weights=lng) / counts, 5)
+    )
+
+def heat_points(lat, lng, weights, radius, max_zoom, heat_grid='auto'):
+    """Return [lat, lng, weight] rows for a HeatMap layer
+
+    heat_grid is one of HEAT_GRID_MODES: 'on' bins points into cells sized for
+    max_zoom, 'off' ships every point and 'auto' bins above HEAT_GRID_THRESHOLD.
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    if heat_grid == 'on' or (heat_grid == 'auto' and lat.size > HEAT_GRID_THRESHOLD):
+        lat, lng, weights = aggregate_grid(lat, lng, weights, cell_size_for_zoom(max_zoom, radius))
+    return np.column_stack([lat, np.asarray(lng, dtype=np.float64), np.asarray(weights, dtype=np.float64)]).tolist()
+
+def build_pyramid(lat, lng, metrics, radius, min_zoom=PYRAMID_MIN_ZOOM, max_zoom=PYRAMID_MAX_ZOOM):
+    """Precompute grid aggregates of several metrics at every zoom level
+
+    metrics maps a metric name to one weight per point. The result is a flat
+    dict of arrays (z<zoom>_lat, z<zoom>_lng, z<zoom>_<metric>) ready for np.savez.
+    Levels stop at the first zoom where no two points share a cell, since every
+    deeper level would be identical.
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lng = np.asarray(lng, dtype=np.float64)
+    weights = {name: np.asarray(values, dtype=np.float64) for name, values in metrics.items()}
+
+    pyramid = {
+        'zooms': np.arange(min_zoom, max_zoom + 1),
+        'metrics': np.array(list(weights), dtype=str)
+    }
+    if lat.size == 0:
+        return pyramid
+    for zoom in pyramid['zooms']:
+        inverse, cell_lat, cell_lng = _grid_cells(lat, lng, cell_size_for_zoom(zoom, radius))
+        pyramid[f'z{zoom}_lat'] = cell_lat
+        pyramid[f'z{zoom}_lng'] = cell_lng
+        for name, values in weights.items():
+            pyramid[f'z{zoom}_{name}'] = np.bincount(inverse, weights=values)
+        if cell_lat.size == lat.size:
+            pyramid['zooms'] = np.arange(min_zoom, zoom + 1)
+            break
+    return pyramid
+
+def save_pyramid(path, pyramid):
+    """Atomically write a pyramid to an .npz file"""
+    with atomic_output(path) as temp_path:
+        with open(temp_path, 'wb') as f:
+            np.savez(f, **pyramid)
+
+def _forget_pyramid(path):
+    global _pyramids_size
+    previous = _pyramids.pop(path, None)
+    if previous is not None:
+        _pyramids_size -= previous[1]
+
+def load_pyramid(path):
+    """Return the pyramid stored at path, cached per process until the file changes
+
+    Pyramids deleted from disk, as when the render cache evicts them, are
+    dropped from memory the next time they are requested.
+    """
+    global _pyramids_size
+    path = os.path.abspath(path)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        with _pyramids_lock:
+            _forget_pyramid(path)
+        raise
+    with _pyramids_lock:
+        cached = _pyramids.get(path)
+        if cached is not None and cached[0] == mtime:
+            _pyramids.move_to_end(path)
+            return cached[2]
+
+    with np.load(path, allow_pickle=False) as npz:
+        pyramid = {name: npz[name] for name in npz.files}
+    size = sum(array.nbytes for array in pyramid.values())
+    with _pyramids_lock:
+        _forget_pyramid(path)
+        # Pyramids too large to share the cache with anything else are not kept
+        if size <= PYRAMID_CACHE_BYTES // 4:
+            _pyramids[path] = (mtime, size, pyramid)
+            _pyramids_size += size
+            while _pyramids_size > PYRAMID_CACHE_BYTES:
+                _forget_pyramid(next(iter(_pyramids)))
+    return pyramid
+
+def query_pyramid(pyramid, bbox, zoom, metric):
+    """Return the pyramid level used for zoom and its [lat, lng, weight] cells inside bbox
+
+    bbox is (south, west, north, east) in degrees. Zooms outside the pyramid
+    are clamped to its nearest level.
+    """
+    if metric not in pyramid['metrics']:
+        raise ValueError(f"Unknown metric {metric!r}")
+    zooms = pyramid['zooms']
+    level = int(np.clip(zoom, zooms.min(), zooms.max()))
+    if f'z{level}_lat' not in pyramid:
+        return level, []
+
+    lat = pyramid[f'z{level}_lat']
+    lng = pyramid[f'z{level}_lng']
+    south, west, north, east = bbox
+    visible = (lat >= south) & (lat <= north) & (lng >= west) & (lng <= east)
+    return level, np.column_stack([lat[visible], lng[visible], pyramid[f'z{level}_{metric}'][visible]]).tolist()
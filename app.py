@@ -1,39 +1,83 @@
-from flask import Flask, request, jsonify, render_template_string, send_from_directory, make_response
-import folium
-from folium.plugins import HeatMap
-import matplotlib.pyplot as plt
-import pandas as pd
-import plotly.graph_objs as go
-import plotly.io as pio
-import base64
-from io import BytesIO
+from flask import Flask, request, jsonify, render_template_string, send_from_directory, make_response, g
+from werkzeug.security import safe_join
+import hmac
 import os
-import re
+import posixpath
+import time
+import uuid
+import aggregation
+import artifacts
+import assets
+import ingest
+from cancer_tensor import LONG_COLUMNS, is_long_format
 import import_data as custom_cancer_map
+import jobs
+import metrics
+import profiling
+import render_cache
+import spans
+import workspaces
 
 app = Flask(__name__)
 
-# Set up upload folder
-UPLOAD_FOLDER = 'uploads'
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
-
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-
 # Set up static folder
 STATIC_FOLDER = '.'
 if not os.path.exists(STATIC_FOLDER):
     os.makedirs(STATIC_FOLDER)
 
-def clear_uploads_folder():
-    """Clear all files in the uploads folder"""
-    for filename in os.listdir(UPLOAD_FOLDER):
-        file_path = os.path.join(UPLOAD_FOLDER, filename)
-        try:
-            if os.path.isfile(file_path):
-                os.unlink(file_path)
-        except Exception as e:
-            print(f"Error deleting file {file_path}: {e}")
+# Delete idle per-session workspaces in the background
+workspaces.start_garbage_collector()
+
+# Requests carrying this token in ADMIN_TOKEN_HEADER may use admin-only
+# options such as profiling; without a configured token nobody can
+ADMIN_TOKEN = os.environ.get('ONCOCONTOUR_ADMIN_TOKEN')
+ADMIN_TOKEN_HEADER = 'X-Admin-Token'
+
+# Bounds of the nearest-place and radius queries over the census
+MAX_NEAREST_PLACES = 50
+MAX_QUERY_POINTS = 10000
+DEFAULT_RADIUS_KM = 25
+MAX_RADIUS_KM = 500
+MAX_RADIUS_PLACES = 1000
+
+# Each gunicorn worker writes its metrics to a file that /metrics adds up
+metrics.start_flusher()
+metrics.add_collector(lambda: [
+    ('oncocontour_artifact_cache_total', {'result': 'hit'}, artifacts.memory_cache.hits),
+    ('oncocontour_artifact_cache_total', {'result': 'miss'}, artifacts.memory_cache.misses)
+])
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.teardown_request
+def record_request_duration(error=None):
+    if 'request_start' in g:
+        metrics.observe(
+            'oncocontour_request_duration_seconds', time.perf_counter() - g.request_start,
+            endpoint=request.endpoint or 'not_found'
+        )
+
+def current_workspace():
+    """Return the id of the requester's workspace, creating one if needed"""
+    if 'workspace_id' not in g:
+        workspace_id = request.cookies.get(workspaces.WORKSPACE_COOKIE)
+        if not workspaces.is_valid_workspace_id(workspace_id):
+            workspace_id = workspaces.new_workspace_id()
+            g.new_workspace = True
+        workspaces.ensure_workspace(workspace_id)
+        g.workspace_id = workspace_id
+    return g.workspace_id
+
+@app.after_request
+def set_workspace_cookie(response):
+    if g.get('new_workspace'):
+        response.set_cookie(
+            workspaces.WORKSPACE_COOKIE, g.workspace_id,
+            max_age=workspaces.workspace_ttl(), httponly=True, samesite='Lax'
+        )
+    return response
 
 # Import page HTML content
 import_page_html = """
@@ -160,6 +204,7 @@ import_page_html = """
                 <div class="file-group">
                     <h3>Cancer Statistics Data</h3>
                     <p>Upload CSV with format: "City,State,CancerType1,CancerType2,...,Year1,Year2,..."</p>
+                    <p>or one row per city, cancer type and year: "City,State,Year,CancerType,Count"</p>
                     <p>State must be 2-letter abbreviation (e.g., RI, MA)</p>
                     <input type="file" id="cancerDataFile" accept=".csv" class="button">
                     <button onclick="uploadFile('cancer')" class="button">Upload Cancer Data</button>
@@ -285,21 +330,79 @@ Female,54344,66057,75425,72340,62843,75137,73676,46375,30832</div>
                 return;
             }
             
-            fetch('/visualize')
+            const visualizeBtn = document.getElementById('visualizeBtn');
+            visualizeBtn.disabled = true;
+            
+            fetch('/visualize', { method: 'POST' })
             .then(response => response.json())
             .then(data => {
                 if (data.success) {
-                    // Redirect to the visualization page
-                    window.location.href = data.redirect;
+                    pollJob(data.status_url);
                 } else {
+                    visualizeBtn.disabled = false;
                     alert('Error: ' + data.message);
                 }
             })
             .catch(error => {
                 console.error('Error:', error);
+                visualizeBtn.disabled = false;
                 alert('Error generating visualization');
             });
         }
+
+        // Polling gives up after this many failed requests in a row, or once the job has run this long
+        const POLL_MAX_FAILURES = 5;
+        const POLL_TIMEOUT_MS = 30 * 60 * 1000;
+
+        function pollJob(statusUrl, startedAt = Date.now(), failures = 0) {
+            const retry = (failed) => setTimeout(() => pollJob(statusUrl, startedAt, failed), 1000);
+            const stop = (message) => {
+                document.getElementById('visualizeBtn').disabled = false;
+                alert(message);
+            };
+            if (Date.now() - startedAt > POLL_TIMEOUT_MS) {
+                stop('Error: Visualization is taking too long; please try again');
+                return;
+            }
+
+            fetch(statusUrl)
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success) {
+                    // Unknown jobs will not appear later, so there is nothing to retry
+                    stop('Error: ' + data.message);
+                    return;
+                }
+                const job = data.job;
+                showJobProgress(job);
+                
+                if (job.status === 'done') {
+                    // Redirect to the visualization page
+                    window.location.href = job.redirect;
+                } else if (job.status === 'failed') {
+                    stop('Error: ' + job.message);
+                } else {
+                    retry(0);
+                }
+            })
+            .catch(error => {
+                console.error('Error:', error);
+                if (failures + 1 < POLL_MAX_FAILURES) {
+                    retry(failures + 1);
+                } else {
+                    stop('Error generating visualization');
+                }
+            });
+        }
+
+        function showJobProgress(job) {
+            const lines = Object.entries(job.stages)
+                .filter(([stage, status]) => status !== 'skipped')
+                .map(([stage, status]) => stage.replace(/_/g, ' ') + ': ' + status);
+            const progressDiv = document.getElementById('visualization');
+            progressDiv.className = 'csv-content';
+            progressDiv.textContent = 'Generating visualization (' + job.status + ')\n' + lines.join('\n');
+        }
     </script>
 </body>
 </html>
@@ -480,6 +583,53 @@ US_STATES = {
     'SD', 'TN', 'TX', 'UT', 'VT', 'VA', 'WA', 'WV', 'WI', 'WY'
 }
 
+# Uploads are validated this many rows at a time, so memory use does not grow with file size
+UPLOAD_CHUNK_ROWS = 50000
+
+def validate_upload(path, file_type):
+    """Check an uploaded CSV chunk by chunk, returning an error message or None if it is valid"""
+    # Imported on first upload so that workers start without it
+    import pandas as pd
+    
+    columns = pd.read_csv(path, nrows=0).columns
+    long_format = file_type == 'cancer' and is_long_format(columns)
+    
+    # Specific validation for cancer data
+    if file_type == 'cancer':
+        # Check required columns
+        if len(columns) < 3:
+            return 'Cancer data must have at least City, State and one data column'
+        
+        # Check first two columns are City and State
+        if columns[0].lower() != 'city' or columns[1].lower() != 'state':
+            return 'First two columns must be "City" and "State"'
+        
+        # Validate remaining columns are either cancer types or years, unless
+        # the file holds one record per city, cancer type and year
+        for col in ([] if long_format else columns[2:]):
+            if not (str(col).isalpha() or str(col).isdigit()):
+                return f'Column "{col}" must be either a cancer type (text) or year (number)'
+    
+    # For other file types, keep existing validation
+    elif file_type == 'countyRace':
+        if columns[0] != 'County':
+            return 'First column must be "County"'
+    elif file_type == 'ageSex':
+        if columns[0] != 'Sex':
+            return 'First column must be "Sex"'
+    
+    # Parse every row, stopping at the first chunk with an invalid state abbreviation
+    for chunk in pd.read_csv(path, chunksize=UPLOAD_CHUNK_ROWS):
+        if file_type == 'cancer' and not chunk.iloc[:, 1].astype(str).str.upper().isin(US_STATES).all():
+            return 'State column must contain valid 2-letter US state abbreviations'
+        if long_format:
+            years = pd.to_numeric(chunk.iloc[:, 2], errors='coerce')
+            if not (years.notna() & (years % 1 == 0)).all():
+                return f'{LONG_COLUMNS[2]} column must contain whole years'
+            if not pd.to_numeric(chunk.iloc[:, 4], errors='coerce').notna().all():
+                return f'{LONG_COLUMNS[4]} column must contain numbers'
+    return None
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     if 'file' not in request.files:
@@ -492,77 +642,25 @@ def upload_file():
         return jsonify({'success': False, 'message': 'No selected file'})
     
     if file and file.filename.endswith('.csv'):
+        upload_folder = workspaces.uploads_folder(current_workspace())
         filename = f"{file_type}_data.csv"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        
-        # Remove existing file if it exists
-        if os.path.exists(filepath):
-            try:
-                os.remove(filepath)
-            except Exception as e:
-                print(f"Error removing existing file: {e}")
+        filepath = os.path.join(upload_folder, filename)
         
+        # Save the file under a unique temporary name to read it, so concurrent
+        # uploads never see each other's partial files
+        temp_path = os.path.join(upload_folder, f"upload-{uuid.uuid4().hex}.tmp")
         try:
-            # Save the file temporarily to read it
-            temp_path = os.path.join(app.config['UPLOAD_FOLDER'], 'temp.csv')
             file.save(temp_path)
             
-            # Read the CSV file
-            df = pd.read_csv(temp_path)
-            
-            # Specific validation for cancer data
-            if file_type == 'cancer':
-                # Check required columns
-                if len(df.columns) < 3:
-                    os.remove(temp_path)
-                    return jsonify({
-                        'success': False,
-                        'message': 'Cancer data must have at least City, State and one data column'
-                    })
-                
-                # Check first two columns are City and State
-                if df.columns[0].lower() != 'city' or df.columns[1].lower() != 'state':
-                    os.remove(temp_path)
-                    return jsonify({
-                        'success': False,
-                        'message': 'First two columns must be "City" and "State"'
-                    })
-                
-                # Validate state abbreviations
-                if not all(str(state).upper() in US_STATES for state in df.iloc[:, 1]):
-                    os.remove(temp_path)
-                    return jsonify({
-                        'success': False,
-                        'message': 'State column must contain valid 2-letter US state abbreviations'
-                    })
-                
-                # Validate remaining columns are either cancer types or years
-                for col in df.columns[2:]:
-                    if not (str(col).isalpha() or str(col).isdigit()):
-                        os.remove(temp_path)
-                        return jsonify({
-                            'success': False,
-                            'message': f'Column "{col}" must be either a cancer type (text) or year (number)'
-                        })
-            
-            # For other file types, keep existing validation
-            elif file_type == 'countyRace':
-                if df.columns[0] != 'County':
-                    os.remove(temp_path)
-                    return jsonify({
-                        'success': False,
-                        'message': 'First column must be "County"'
-                    })
-            elif file_type == 'ageSex':
-                if df.columns[0] != 'Sex':
-                    os.remove(temp_path)
-                    return jsonify({
-                        'success': False,
-                        'message': 'First column must be "Sex"'
-                    })
+            error = validate_upload(temp_path, file_type)
+            if error:
+                os.remove(temp_path)
+                return jsonify({'success': False, 'message': error})
             
-            # If validation passed, move the temp file to final location
-            os.rename(temp_path, filepath)
+            # Store the typed conversion first, then atomically replace any previous upload
+            ingest.convert_upload(temp_path, file_type, filepath, chunk_rows=UPLOAD_CHUNK_ROWS)
+            os.replace(temp_path, filepath)
+            metrics.observe('oncocontour_upload_bytes', os.path.getsize(filepath), type=file_type)
             
             return jsonify({
                 'success': True,
@@ -583,24 +681,153 @@ def upload_file():
         'message': 'Invalid file format. Please upload a CSV file.'
     })
 
+@app.route(f'{assets.ASSET_URL_PREFIX}/<version>/<path:filename>')
+def vendored_asset(version, filename):
+    """Serve a vendored script or stylesheet; a version never changes, so browsers may cache it for good"""
+    if version != assets.vendored_version():
+        return "File not found", 404
+    response = send_from_directory(assets.version_folder(version), filename)
+    response.headers['Cache-Control'] = assets.ASSET_CACHE_CONTROL
+    return response
+
+@app.route('/metrics')
+def metrics_page():
+    """Report the metrics of every worker in the Prometheus text format"""
+    metrics.flush()
+    response = make_response(metrics.render(metrics.aggregate()))
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+@app.route('/api/cache')
+def cache_stats():
+    """Report the in-memory artifact cache counters of the worker handling the request"""
+    return jsonify(dict(artifacts.memory_cache.stats(), pid=os.getpid()))
+
+def is_private_path(filename):
+    """Tell whether a path is kept from the static file route
+
+    Workspaces hold a session's uploads and jobs under its credential, so they
+    are never served; of the report folders only the published outputs are.
+    """
+    filename = posixpath.normpath(filename)
+    top = filename.split('/', 1)[0]
+    if top == workspaces.WORKSPACE_ROOT:
+        return True
+    return top == workspaces.REPORT_ROOT and not workspaces.is_output_path(filename)
+
 @app.route('/<path:filename>')
 def serve_file(filename):
+    if is_private_path(filename):
+        return "File not found", 404
     if filename.endswith('.html'):
+        path = safe_join(STATIC_FOLDER, filename)
         try:
-            with open(filename, 'r') as f:
-                content = f.read()
-                response = make_response(content)
-                response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
-                return response
+            stat = os.stat(path) if path else None
         except FileNotFoundError:
+            stat = None
+        if stat is None:
             return "File not found", 404
+        
+        # Pages are regenerated in place, so browsers must revalidate every time;
+        # an unchanged page costs a 304 instead of a download
+        content_hash = artifacts.etag(path, stat)
+        encoding, variant = artifacts.negotiate(path, request.accept_encodings, stat)
+        tag = f"{content_hash}-{encoding}" if encoding else content_hash
+        if any(value.split('-')[0] == content_hash for value in request.if_none_match.as_set(include_weak=True)):
+            response = make_response('', 304)
+        else:
+            # Hot pages and their compressed variants are served from memory
+            variant_stat = os.stat(variant) if encoding else stat
+            response = make_response(artifacts.memory_cache.read(variant, variant_stat))
+            response.mimetype = 'text/html'
+            if encoding:
+                response.headers['Content-Encoding'] = encoding
+        response.set_etag(tag)
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
     return send_from_directory(STATIC_FOLDER, filename)
 
-@app.route('/visualize')
+def visualization_options():
+    """Read the rendering options of a /visualize request from its query string or form"""
+    options = {
+        'marker_mode': request.values.get('marker_mode', 'auto'),
+        'heat_grid': request.values.get('heat_grid', 'auto'),
+        'heat_source': request.values.get('heat_source', 'auto'),
+        'report_mode': request.values.get('report_mode', 'single')
+    }
+    allowed = {
+        'marker_mode': custom_cancer_map.MARKER_MODES,
+        'heat_grid': custom_cancer_map.HEAT_GRID_MODES,
+        'heat_source': custom_cancer_map.HEAT_SOURCES,
+        'report_mode': custom_cancer_map.REPORT_MODES
+    }
+    for name, values in allowed.items():
+        if options[name] not in values:
+            raise ValueError(f"{name} must be one of {', '.join(values)}")
+    return options
+
+def is_admin_request():
+    token = request.headers.get(ADMIN_TOKEN_HEADER, '')
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode('utf-8'), ADMIN_TOKEN.encode('utf-8'))
+
+def run_visualization(workspace_id, options=None, progress=None, profiler=None):
+    """Generate a workspace's visualization report and describe the outcome as a job result
+
+    The result lists the timing and resource spans of every stage (see spans.span)
+    and links to the list of loosely matched cities when there is one. With a
+    profiler from profiling.PROFILERS the run is profiled, and the result
+    links to the profile saved next to the report.
+    """
+    kwargs = dict(
+        uploads_folder=workspaces.uploads_folder(workspace_id),
+        output_folder=workspaces.output_folder(workspace_id),
+        progress=progress,
+        **(options or {})
+    )
+    with spans.collect() as trace:
+        with spans.span('visualize'):
+            if profiler:
+                # Profilers only see the calling thread, so every stage is rendered serially in it
+                kwargs.update(workers=1, use_render_cache=False)
+                profile_file = profiling.PROFILE_FILES[profiler]
+                success = profiling.profile_call(
+                    profiler, workspaces.output_path(workspace_id, profile_file),
+                    custom_cancer_map.generate_visualization, **kwargs
+                )
+            else:
+                success = custom_cancer_map.generate_visualization(**kwargs)
+    for finished in trace:
+        metrics.observe(
+            'oncocontour_render_span_seconds', finished['wall_seconds'],
+            span=finished['name'], parent=finished['parent'] or ''
+        )
+    
+    if success:
+        result = {
+            'status': 'done',
+            'redirect': workspaces.output_url(workspace_id, custom_cancer_map.REPORT_FILE),
+            'spans': trace
+        }
+    else:
+        result = {
+            'status': 'failed',
+            'message': 'Error generating visualization. Please check that you have uploaded the necessary data files.',
+            'spans': trace
+        }
+    if profiler:
+        result['profile'] = workspaces.output_url(workspace_id, profile_file)
+    if os.path.exists(workspaces.output_path(workspace_id, custom_cancer_map.MATCH_REPORT_FILE)):
+        result['match_report'] = workspaces.output_url(workspace_id, custom_cancer_map.MATCH_REPORT_FILE)
+    return result
+
+@app.route('/visualize', methods=['GET', 'POST'])
 def visualize():
     try:
+        workspace_id = current_workspace()
+        
         # Check if at least one file exists in the upload folder
-        uploaded_files = [f for f in os.listdir(UPLOAD_FOLDER) if f.endswith('.csv')]
+        uploaded_files = [f for f in os.listdir(workspaces.uploads_folder(workspace_id)) if f.endswith('.csv')]
         
         if not uploaded_files:
             return jsonify({
@@ -608,20 +835,56 @@ def visualize():
                 'message': 'No data files found. Please upload at least one file before generating visualizations.'
             })
         
-        # Call the custom cancer map generator
-        success = custom_cancer_map.generate_visualization(uploads_folder=UPLOAD_FOLDER)
+        try:
+            options = visualization_options()
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
         
-        if success:
-            # Return the path to the visualization as JSON
+        # ?profile=cprofile or ?profile=sample profiles the run, for admins only
+        profiler = request.values.get('profile')
+        if profiler:
+            if profiler not in profiling.PROFILERS:
+                return jsonify({
+                    'success': False, 'message': f"profile must be one of {', '.join(profiling.PROFILERS)}"
+                }), 400
+            if not is_admin_request():
+                return jsonify({'success': False, 'message': 'Profiling is restricted to admins'}), 403
+        
+        # POST queues the rendering and returns immediately; poll /jobs/<id> for progress
+        if request.method == 'POST':
+            jobs_folder = workspaces.jobs_folder(workspace_id)
+            job = jobs.create_job(custom_cancer_map.VISUALIZATION_STAGES, jobs_folder)
+            metrics.inc('oncocontour_jobs_in_flight')
+            future = jobs.submit_job(
+                job['id'], run_visualization, workspace_id, options, jobs_folder=jobs_folder, profiler=profiler
+            )
+            future.add_done_callback(lambda _: metrics.dec('oncocontour_jobs_in_flight'))
             return jsonify({
                 'success': True,
-                'redirect': '/custom_cancer_map_v12_4.html'
-            })
+                'job_id': job['id'],
+                'status_url': f"/jobs/{job['id']}"
+            }), 202
+        
+        # GET renders synchronously inside the request
+        result = run_visualization(workspace_id, options, profiler=profiler)
+        
+        if result['status'] == 'done':
+            # Return the path to the visualization as JSON
+            response = {
+                'success': True,
+                'redirect': result['redirect'],
+                'spans': result['spans']
+            }
         else:
-            return jsonify({
+            response = {
                 'success': False,
-                'message': 'Error generating visualization. Please check that you have uploaded the necessary data files.'
-            })
+                'message': result['message'],
+                'spans': result['spans']
+            }
+        for link in ('profile', 'match_report'):
+            if link in result:
+                response[link] = result[link]
+        return jsonify(response)
             
     except Exception as e:
         return jsonify({
@@ -629,5 +892,112 @@ def visualize():
             'message': f'Error generating visualization: {str(e)}'
         })
 
+@app.route(f'{custom_cancer_map.HEAT_API_URL}/<key>')
+def heat_points(key):
+    """Return the aggregated heat cells of a dataset's pyramid that fall inside a bbox
+
+    Pyramids are named by their render cache key rather than found in the
+    requester's workspace, so shared and reopened reports keep their heat layer.
+    """
+    if not render_cache.is_valid_key(key):
+        return jsonify({'success': False, 'message': 'Invalid heat data key'}), 404
+    pyramid_path = render_cache.entry_path(key, custom_cancer_map.PYRAMID_SUFFIX)
+    try:
+        bbox = [float(value) for value in request.args.get('bbox', '').split(',')]
+        if len(bbox) != 4:
+            raise ValueError('bbox must be south,west,north,east')
+        zoom = int(request.args.get('zoom', custom_cancer_map.HEAT_MAX_ZOOM))
+        metric = request.args.get('metric', 'CancerRate')
+        level, points = aggregation.query_pyramid(aggregation.load_pyramid(pyramid_path), bbox, zoom, metric)
+    except FileNotFoundError:
+        return jsonify({
+            'success': False, 'message': 'No heat data found; generate the visualization again to rebuild it'
+        }), 404
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    return jsonify({'success': True, 'zoom': level, 'points': points})
+
+def place_records(gazetteer, rows, distances):
+    """Describe census places and their distances from a query point as JSON records"""
+    found = rows >= 0
+    places = gazetteer.columns(rows[found])
+    places['distance_km'] = distances[found].round(3)
+    return places.to_dict('records')
+
+def query_point(lat, lng):
+    """Parse a latitude and longitude in degrees, raising ValueError if either is invalid"""
+    lat, lng = float(lat), float(lng)
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError('lat must be within -90..90 and lng within -180..180')
+    return lat, lng
+
+@app.route('/api/places/nearest', methods=['GET', 'POST'])
+def nearest_places():
+    """Return the k census places nearest to a point, or to each of a batch of points
+
+    GET takes lat and lng; POST takes JSON {"points": [[lat, lng], ...]} to
+    geocode many coordinates at once. k defaults to 1.
+    """
+    import numpy as np
+    import census
+    try:
+        k = int(request.args.get('k', 1))
+        if not 1 <= k <= MAX_NEAREST_PLACES:
+            raise ValueError(f'k must be between 1 and {MAX_NEAREST_PLACES}')
+        if request.method == 'POST':
+            points = (request.get_json(silent=True) or {}).get('points')
+            if not isinstance(points, list) or not 0 < len(points) <= MAX_QUERY_POINTS or not all(
+                isinstance(point, list) and len(point) == 2 for point in points
+            ):
+                raise ValueError(f'points must be a list of 1 to {MAX_QUERY_POINTS} [lat, lng] pairs')
+            points = [query_point(*point) for point in points]
+        else:
+            points = [query_point(request.args.get('lat', ''), request.args.get('lng', ''))]
+    except (TypeError, ValueError) as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    gazetteer = census.get_gazetteer(census.CENSUS_FILE)
+    points = np.asarray(points, dtype=np.float64)
+    rows, distances = gazetteer.places.nearest(points[:, 0], points[:, 1], k)
+    results = [place_records(gazetteer, rows[i], distances[i]) for i in range(len(points))]
+    if request.method == 'POST':
+        return jsonify({'success': True, 'results': results})
+    return jsonify({'success': True, 'places': results[0]})
+
+@app.route('/api/places/within')
+def places_within():
+    """Return the census places within radius_km of lat, lng, nearest first, up to limit of them"""
+    import census
+    try:
+        lat, lng = query_point(request.args.get('lat', ''), request.args.get('lng', ''))
+        radius_km = float(request.args.get('radius_km', DEFAULT_RADIUS_KM))
+        if not 0 <= radius_km <= MAX_RADIUS_KM:
+            raise ValueError(f'radius_km must be between 0 and {MAX_RADIUS_KM}')
+        limit = int(request.args.get('limit', MAX_RADIUS_PLACES))
+        if not 1 <= limit <= MAX_RADIUS_PLACES:
+            raise ValueError(f'limit must be between 1 and {MAX_RADIUS_PLACES}')
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    gazetteer = census.get_gazetteer(census.CENSUS_FILE)
+    rows, distances = gazetteer.places.within(lat, lng, radius_km)
+    return jsonify({
+        'success': True,
+        'count': len(rows),
+        'places': place_records(gazetteer, rows[:limit], distances[:limit])
+    })
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    # Jobs are only visible from the workspace that started them
+    job = jobs.get_job(job_id, workspaces.jobs_folder(current_workspace()))
+    if job is None:
+        return jsonify({'success': False, 'message': 'Job not found'}), 404
+    
+    response = jsonify({'success': True, 'job': job})
+    response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
+    return response
+
 if __name__ == '__main__':
     app.run(debug=True)
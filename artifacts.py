@@ -0,0 +1,163 @@
+import gzip
+import hashlib
+import os
+import sys
+import threading
+from collections import OrderedDict
+from workspaces import atomic_write
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; without it only gzip variants are written
+    brotli = None
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 6
+
+# Precompressed variants of an artifact, in order of preference
+ENCODINGS = {'br': '.br', 'gzip': '.gz'}
+
+# Content hashes of served files, keyed by path and reused until the file changes;
+# the least recently used are dropped beyond ETAG_CACHE_ENTRIES
+ETAG_CACHE_ENTRIES = 4096
+_etags = OrderedDict()
+_etags_lock = threading.Lock()
+
+# Total size of the served files kept in memory by each process
+DEFAULT_MEMORY_CACHE_BYTES = 64 * 1024 * 1024
+
+def _stat_signature(stat):
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+def variant_path(path, encoding):
+    return path + ENCODINGS[encoding]
+
+def publish(path):
+    """Write the precompressed variants of a freshly written artifact next to it"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    atomic_write(variant_path(path, 'gzip'), gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0))
+    if brotli is not None:
+        atomic_write(variant_path(path, 'br'), brotli.compress(data, quality=BROTLI_QUALITY))
+    return path
+
+def remove(path):
+    """Delete an artifact together with its precompressed variants"""
+    for candidate in [path] + [variant_path(path, encoding) for encoding in ENCODINGS]:
+        if os.path.exists(candidate):
+            os.remove(candidate)
+
+def etag(path, stat=None):
+    """Return the content hash of a file, hashing it again only after it changes"""
+    stat = stat or os.stat(path)
+    signature = _stat_signature(stat)
+    with _etags_lock:
+        cached = _etags.get(path)
+        if cached is not None and cached[0] == signature:
+            _etags.move_to_end(path)
+            return cached[1]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    content_hash = digest.hexdigest()[:32]
+    with _etags_lock:
+        _etags[path] = (signature, content_hash)
+        _etags.move_to_end(path)
+        while len(_etags) > ETAG_CACHE_ENTRIES:
+            _etags.popitem(last=False)
+    return content_hash
+
+def fresh_variant(path, encoding, stat=None):
+    """Return the path of an encoded variant written after the artifact's last change, or None
+
+    Variants left behind by an earlier version of the artifact are older than
+    it and are never served.
+    """
+    stat = stat or os.stat(path)
+    candidate = variant_path(path, encoding)
+    try:
+        if os.stat(candidate).st_mtime_ns >= stat.st_mtime_ns:
+            return candidate
+    except FileNotFoundError:
+        pass
+    return None
+
+def negotiate(path, accept_encodings, stat=None):
+    """Pick the best fresh variant the client accepts, returning (encoding, path)
+
+    accept_encodings is Flask's request.accept_encodings; (None, path) means
+    the artifact is sent uncompressed.
+    """
+    for encoding in ENCODINGS:
+        if accept_encodings[encoding]:
+            candidate = fresh_variant(path, encoding, stat)
+            if candidate:
+                return encoding, candidate
+    return None, path
+
+class MemoryCache:
+    """Byte-bounded LRU cache of file contents, validated against each file's stat
+
+    Counts hits, misses and evictions so the bound can be sized for real traffic.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def read(self, path, stat=None):
+        """Return the contents of path, from memory unless the file changed since it was cached"""
+        stat = stat or os.stat(path)
+        signature = _stat_signature(stat)
+        with self.lock:
+            cached = self.entries.get(path)
+            if cached is not None and cached[0] == signature:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        # Files too large to share the cache with anything else are not kept
+        if len(data) <= self.max_bytes // 4:
+            self.store(path, signature, data)
+        return data
+
+    def store(self, path, signature, data):
+        with self.lock:
+            previous = self.entries.pop(path, None)
+            if previous is not None:
+                self.size -= len(previous[1])
+            self.entries[path] = (signature, data)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+memory_cache = MemoryCache(int(os.environ.get('ONCOCONTOUR_ARTIFACT_CACHE_BYTES', DEFAULT_MEMORY_CACHE_BYTES)))
+
+# Precompress files that ship with the app, such as the landing page map
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        publish(path)
+        print(f"Precompressed {path}")
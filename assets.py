@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+from urllib.parse import urljoin, urlsplit
+from workspaces import atomic_write
+
+# Third-party JavaScript and CSS used by the generated pages are vendored here,
+# one directory per asset version, and served from ASSET_URL_PREFIX
+ASSET_FOLDER = 'vendor'
+ASSET_URL_PREFIX = '/vendor'
+MANIFEST_FILE = 'manifest.json'
+
+# Vendored assets never change under a given version, so browsers may keep them for a year
+ASSET_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+DOWNLOAD_TIMEOUT = 30
+
+# Relative url(...) references in stylesheets, such as fonts and marker images
+CSS_URL_PATTERN = re.compile(r'url\(\s*[\'"]?([^\'")]+)[\'"]?\s*\)')
+
+# Scripts and stylesheets loaded by a static page, such as the landing page's demo map
+PAGE_ASSET_PATTERN = re.compile(r'<(?:script|link)\b[^>]*?\b(?:src|href)="(https?://[^"]+)"', re.IGNORECASE)
+
+_manifest = None
+
+def plotly_cdn_url():
+    from plotly.io._utils import plotly_cdn_url
+    return plotly_cdn_url()
+
+def cdn_urls():
+    """Return the CDN URLs of every script and stylesheet the maps and charts load"""
+    from folium.folium import _default_css, _default_js
+    from folium.plugins import HeatMap, MarkerCluster
+    urls = [url for _, url in _default_js + _default_css]
+    urls += [url for _, url in HeatMap.default_js + MarkerCluster.default_js + MarkerCluster.default_css]
+    return urls
+
+def page_urls(path):
+    """Return the CDN URLs of the scripts and stylesheets a static page loads"""
+    with open(path, encoding='utf-8') as f:
+        return list(dict.fromkeys(PAGE_ASSET_PATTERN.findall(f.read())))
+
+def asset_version():
+    """Hash the asset URLs, which embed their library versions, together with plotly's"""
+    import plotly
+    digest = hashlib.sha256(json.dumps([plotly.__version__] + sorted(cdn_urls())).encode('utf-8'))
+    return digest.hexdigest()[:12]
+
+def version_folder(version, root=ASSET_FOLDER):
+    return os.path.join(root, version)
+
+def local_path(url):
+    """Return where a CDN URL is stored inside a version folder, keeping its directory layout
+
+    Keeping the layout lets stylesheets find their fonts and images through
+    the same relative URLs they use on the CDN.
+    """
+    parts = urlsplit(url)
+    return os.path.normpath(os.path.join(parts.netloc, parts.path.lstrip('/')))
+
+def download(url, dest):
+    from urllib.request import urlopen
+    with urlopen(url, timeout=DOWNLOAD_TIMEOUT) as response:
+        data = response.read()
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    atomic_write(dest, data)
+    return data
+
+def stylesheet_references(css_url, css):
+    """Return the absolute URLs of the relative resources a stylesheet refers to"""
+    references = []
+    for reference in CSS_URL_PATTERN.findall(css):
+        if reference.startswith(('data:', '#')) or urlsplit(reference).scheme:
+            continue
+        url = urljoin(css_url, reference).split('#')[0].split('?')[0]
+        if url not in references:
+            references.append(url)
+    return references
+
+def vendor_assets(root=ASSET_FOLDER, pages=()):
+    """Download every CDN asset into a new version folder and write its manifest
+
+    The assets of the static pages listed in pages are vendored as well.
+    Assets that cannot be downloaded are left out of the manifest, so pages
+    keep loading them from the CDN. Older version folders are removed.
+    """
+    global _manifest
+    import plotly.offline
+    version = asset_version()
+    folder = version_folder(version, root)
+
+    manifest = {}
+    plotly_path = os.path.join('plotly', os.path.basename(urlsplit(plotly_cdn_url()).path))
+    os.makedirs(os.path.join(folder, 'plotly'), exist_ok=True)
+    atomic_write(os.path.join(folder, plotly_path), plotly.offline.get_plotlyjs())
+    manifest[plotly_cdn_url()] = plotly_path
+
+    for url in dict.fromkeys(cdn_urls() + [url for page in pages for url in page_urls(page)]):
+        path = local_path(url)
+        try:
+            data = download(url, os.path.join(folder, path))
+        except OSError as e:
+            print(f"Error downloading {url}: {e}")
+            continue
+        manifest[url] = path
+
+        if url.endswith('.css'):
+            for reference in stylesheet_references(url, data.decode('utf-8', errors='replace')):
+                try:
+                    download(reference, os.path.join(folder, local_path(reference)))
+                except OSError as e:
+                    print(f"Error downloading {reference}: {e}")
+
+    atomic_write(os.path.join(folder, MANIFEST_FILE), json.dumps(manifest, indent=2))
+
+    for entry in os.scandir(root):
+        if entry.is_dir() and entry.name != version:
+            shutil.rmtree(entry.path, ignore_errors=True)
+    _manifest = None
+    return version, manifest
+
+def get_manifest(root=ASSET_FOLDER):
+    """Return the vendored URL map of the current asset version, or {} if assets are not vendored"""
+    global _manifest
+    if _manifest is None:
+        version = asset_version()
+        try:
+            with open(os.path.join(version_folder(version, root), MANIFEST_FILE)) as f:
+                urls = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            urls = {}
+        _manifest = (version, urls)
+    return _manifest
+
+def vendored_version():
+    """Return the asset version that pages are rewritten to, or None when serving from CDNs"""
+    version, urls = get_manifest()
+    return version if urls else None
+
+def asset_url(url):
+    """Return the app URL serving a vendored asset, or url itself if it is not vendored"""
+    version, urls = get_manifest()
+    if url not in urls:
+        return url
+    return f"{ASSET_URL_PREFIX}/{version}/{urls[url]}"
+
+def rewrite_urls(html):
+    """Point every vendored CDN URL in a page at the app's asset route"""
+    version, urls = get_manifest()
+    for url in urls:
+        html = html.replace(url, asset_url(url))
+    return html
+
+def rewrite_page(path):
+    """Rewrite a static page in place so it loads its vendored assets from the app"""
+    with open(path, encoding='utf-8') as f:
+        html = f.read()
+    atomic_write(path, rewrite_urls(html))
+
+# Run at image build time so the app never has to reach a CDN; static pages
+# given as arguments are vendored too and rewritten in place
+if __name__ == "__main__":
+    pages = sys.argv[1:]
+    version, manifest = vendor_assets(pages=pages)
+    for page in pages:
+        rewrite_page(page)
+    print(f"Vendored {len(manifest)} assets as version {version}")
@@ -0,0 +1,298 @@
+"""Benchmark uploads, rendering stages and create_* functions on synthetic data
+
+Uploads are synthesized by sampling real cities from processed_census_data.csv
+at several scales. Every measurement runs in a fresh interpreter inside its
+own scratch directory, recording wall time, peak RSS and output bytes. Peak
+RSS is reset before every case and stage, so each one reports its own peak:
+
+    python benchmark.py --update-baseline      # record benchmark_baseline.json
+    python benchmark.py                        # compare against it
+
+The run fails when a case regresses beyond the tolerance, or when importing
+the app takes longer than STARTUP_BUDGET_SECONDS. The start-up check alone is
+quick enough to run on every change:
+
+    python benchmark.py --startup-only
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import spans
+
+CENSUS_FILE = 'processed_census_data.csv'
+BASELINE_FILE = 'benchmark_baseline.json'
+DEFAULT_SCALES = [10, 1000, 10000, 31000]
+DEFAULT_TOLERANCE = 0.25
+
+# Differences below these are noise, whatever the tolerance says
+MIN_SECONDS_REGRESSION = 0.05
+MIN_RSS_MB_REGRESSION = 16
+
+# Importing the app, as each gunicorn worker does at boot, must stay within this
+STARTUP_BUDGET_SECONDS = 1.0
+
+CANCER_TYPES = ['Bladder', 'Breast', 'Colorectal', 'Lung', 'Melanoma', 'Prostate']
+YEARS = list(range(2015, 2022))
+RACES = ['White', 'Hispanic or Latino', 'Black', 'American Indian', 'Asian', 'Pacific Islander', 'Other',
+         'Two or More']
+AGE_GROUPS = ['0-9', '10-19', '20-29', '30-39', '40-49', '50-59', '60-69', '70-79', '80+']
+
+def generate_uploads(folder, cities, census_path=CENSUS_FILE, seed=0):
+    """Write cancer, county race and age/sex uploads for a sample of real census cities"""
+    import numpy as np
+    import pandas as pd
+    from app import US_STATES
+
+    rng = np.random.default_rng(seed)
+    census = pd.read_csv(census_path)
+    # Cities without residents have no cancer rate, so they never appear in real uploads
+    census = census[census['state_id'].isin(US_STATES) & (census['population'] > 0)]
+    sample = census.sample(n=min(cities, len(census)), random_state=seed).reset_index(drop=True)
+    population = sample['population'].to_numpy(dtype=np.float64)
+
+    cancer = pd.DataFrame({'City': sample['city'], 'State': sample['state_id']})
+    for cancer_type in CANCER_TYPES:
+        cancer[cancer_type] = rng.poisson(population * rng.uniform(0.0005, 0.005))
+    trend = rng.uniform(0.95, 1.05, size=len(sample))
+    for i, year in enumerate(YEARS):
+        cancer[str(year)] = rng.poisson(population * 0.004 * trend ** i)
+
+    counties = sample.groupby('county_name')['population'].sum()
+    county_race = pd.DataFrame({'County': counties.index})
+    shares = rng.dirichlet(np.ones(len(RACES)), size=len(counties))
+    for i, race in enumerate(RACES):
+        county_race[race] = (counties.to_numpy() * shares[:, i]).astype(np.int64)
+
+    total = population.sum()
+    age_sex = pd.DataFrame({'Sex': ['Male', 'Female']})
+    for group in AGE_GROUPS:
+        age_sex[group] = (total * rng.dirichlet(np.ones(2)) / len(AGE_GROUPS)).astype(np.int64)
+
+    os.makedirs(folder, exist_ok=True)
+    paths = {
+        'cancer': os.path.join(folder, 'cancer_data.csv'),
+        'countyRace': os.path.join(folder, 'countyRace_data.csv'),
+        'ageSex': os.path.join(folder, 'ageSex_data.csv')
+    }
+    cancer.to_csv(paths['cancer'], index=False)
+    county_race.to_csv(paths['countyRace'], index=False)
+    age_sex.to_csv(paths['ageSex'], index=False)
+    return paths
+
+def peak_rss_mb():
+    """Return the peak RSS since the last spans.reset_peak_rss, in megabytes"""
+    return spans.peak_rss_bytes() / (1 << 20)
+
+def file_bytes(*paths):
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+def _prepare(workdir, source_dir, scale):
+    """Enter a scratch directory holding the census, its compiled cache and the synthetic uploads"""
+    os.chdir(workdir)
+    sys.path.insert(0, source_dir)
+    shutil.copy(os.path.join(source_dir, CENSUS_FILE), CENSUS_FILE)
+    # Compiled in its own process, as at image build time, so its memory peak is not measured
+    subprocess.run([sys.executable, os.path.join(source_dir, 'census.py')], check=True, stdout=subprocess.DEVNULL)
+    return generate_uploads('synthetic', scale)
+
+def _run_flask(workdir, source_dir, scale):
+    """Upload the files and render the report through the Flask test client"""
+    paths = _prepare(workdir, source_dir, scale)
+    import app
+    client = app.app.test_client()
+    results = {}
+    for file_type, path in paths.items():
+        spans.reset_peak_rss()
+        start = time.perf_counter()
+        with open(path, 'rb') as f:
+            response = client.post('/upload', data={'type': file_type, 'file': (f, os.path.basename(path))},
+                                   content_type='multipart/form-data')
+        if not response.get_json()['success']:
+            raise RuntimeError(f"Upload of {file_type} failed: {response.get_json()['message']}")
+        results[f'upload/{file_type}'] = {
+            'seconds': time.perf_counter() - start, 'peak_rss_mb': peak_rss_mb(), 'bytes': file_bytes(path)
+        }
+
+    spans.reset_peak_rss()
+    start = time.perf_counter()
+    response = client.get('/visualize')
+    if not response.get_json()['success']:
+        raise RuntimeError(f"Visualization failed: {response.get_json()['message']}")
+    workspace = client.get_cookie(app.workspaces.WORKSPACE_COOKIE).value
+    outputs = [entry.path for entry in os.scandir(app.workspaces.output_folder(workspace)) if entry.is_file()]
+    results['visualize'] = {'seconds': time.perf_counter() - start, 'peak_rss_mb': peak_rss_mb(), 'bytes': file_bytes(*outputs)}
+    return results
+
+def _run_stages(workdir, source_dir, scale):
+    """Time each stage of generate_visualization, rendering in-process"""
+    paths = _prepare(workdir, source_dir, scale)
+    import import_data
+    import render_cache
+    uploads = os.path.dirname(paths['cancer'])
+    started = {}
+    results = {}
+
+    def progress(stage, status):
+        now = time.perf_counter()
+        if status == 'running':
+            spans.reset_peak_rss()
+            started[stage] = now
+        elif status == 'done' and stage in started:
+            results[f'stage/{stage}'] = {'seconds': now - started[stage], 'peak_rss_mb': peak_rss_mb()}
+
+    if not import_data.generate_visualization(uploads_folder=uploads, output_folder='.', progress=progress, workers=1):
+        raise RuntimeError("generate_visualization failed")
+    for name, output in import_data.OUTPUT_FILES.items():
+        if f'stage/{name}' in results:
+            results[f'stage/{name}']['bytes'] = file_bytes(
+                output, os.path.splitext(output)[0] + import_data.FRAGMENT_SUFFIX
+            )
+    if 'stage/heat_pyramid' in results:
+        results['stage/heat_pyramid']['bytes'] = file_bytes(*glob.glob(
+            render_cache.entry_path('*', import_data.PYRAMID_SUFFIX)
+        ))
+    if 'stage/report' in results:
+        results['stage/report']['bytes'] = file_bytes(import_data.REPORT_FILE)
+    return results
+
+def _run_create(workdir, source_dir, scale):
+    """Time each create_* function on its own, writing standalone pages"""
+    paths = _prepare(workdir, source_dir, scale)
+    import ingest
+    import import_data
+    from census import get_gazetteer
+    # Imported up front, as generate_visualization does, so the first call does not pay for them
+    import folium.plugins
+    import plotly.graph_objs
+    import map_layers
+
+    cancer, schema = ingest.load_upload(paths['cancer'], 'cancer')
+    merged, _ = get_gazetteer(CENSUS_FILE).merge(cancer)
+    cancer_cols, year_cols = schema['cancer_cols'], schema['year_cols']
+    county_race, _ = ingest.load_upload(paths['countyRace'], 'countyRace')
+    age_sex, _ = ingest.load_upload(paths['ageSex'], 'ageSex')
+
+    calls = {
+        'create_population_heatmap': (
+            import_data.create_population_heatmap, (merged[['lat', 'lng', 'population']],)
+        ),
+        'create_cancer_incidence_map': (
+            import_data.create_cancer_incidence_map,
+            (merged[['City', 'State', 'lat', 'lng', 'population'] + cancer_cols], cancer_cols)
+        ),
+        'create_trend_analysis': (
+            import_data.create_trend_analysis,
+            (merged['City'].to_numpy(), [int(year) for year in year_cols], merged[year_cols].to_numpy())
+        ),
+        'create_cancer_distribution_chart': (
+            import_data.create_cancer_distribution_chart,
+            (cancer_cols, merged[cancer_cols].to_numpy().sum(axis=0))
+        ),
+        'create_race_demographics_chart': (import_data.create_race_demographics_chart, (county_race,)),
+        'create_age_distribution_chart': (import_data.create_age_distribution_chart, (age_sex,))
+    }
+    results = {}
+    for name, (func, args) in calls.items():
+        output_file = f'{name}.html'
+        spans.reset_peak_rss()
+        start = time.perf_counter()
+        func(*args, output_file=output_file)
+        results[f'create/{name}'] = {
+            'seconds': time.perf_counter() - start, 'peak_rss_mb': peak_rss_mb(), 'bytes': file_bytes(output_file)
+        }
+    return results
+
+def measure_startup(source_dir, repeat=3):
+    """Return the fastest of several cold imports of the app, in seconds"""
+    timings = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as workdir:
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', 'import app'], cwd=workdir, check=True,
+                           env=dict(os.environ, PYTHONPATH=source_dir))
+            timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def startup_regressions(seconds):
+    if seconds > STARTUP_BUDGET_SECONDS:
+        return [f"startup/import_app seconds: {seconds:.2f} exceeds budget {STARTUP_BUDGET_SECONDS:.2f}"]
+    return []
+
+def run_benchmarks(scales):
+    """Run every suite at every scale, each in a fresh interpreter and scratch directory"""
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    results = {'startup/import_app': {'seconds': measure_startup(source_dir)}}
+    print(f"{'':>6} {'startup/import_app':<45} {results['startup/import_app']['seconds']:8.2f} s")
+    context = multiprocessing.get_context('spawn')
+    for scale in scales:
+        for suite in (_run_flask, _run_stages, _run_create):
+            with tempfile.TemporaryDirectory() as workdir, \
+                    ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                measured = pool.submit(suite, workdir, source_dir, scale).result()
+            for case, values in measured.items():
+                results[f'{scale}/{case}'] = values
+                print(f"{scale:>6} {case:<45} {values['seconds']:8.2f} s"
+                      f"{values.get('peak_rss_mb', 0):9.0f} MB{values.get('bytes', 0):>12,} B")
+    return results
+
+def regressions(results, baseline, tolerance):
+    """List the cases that got slower, bigger or hungrier than the baseline allows"""
+    slack = {'seconds': MIN_SECONDS_REGRESSION, 'peak_rss_mb': MIN_RSS_MB_REGRESSION, 'bytes': 0}
+    found = []
+    for case, values in results.items():
+        for metric, value in values.items():
+            previous = baseline.get(case, {}).get(metric)
+            if previous is not None and value > previous * (1 + tolerance) + slack[metric]:
+                found.append(f"{case} {metric}: {value:.2f} vs baseline {previous:.2f}")
+    return found + startup_regressions(results['startup/import_app']['seconds'])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scales', default=','.join(map(str, DEFAULT_SCALES)),
+                        help='comma-separated numbers of cities')
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='allowed relative regression, e.g. 0.25 for 25%%')
+    parser.add_argument('--update-baseline', action='store_true', help='record the results as the new baseline')
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    parser.add_argument('--startup-only', action='store_true',
+                        help='only check the time it takes to import the app against its budget')
+    args = parser.parse_args()
+
+    if args.startup_only:
+        seconds = measure_startup(os.path.dirname(os.path.abspath(__file__)))
+        print(f"startup/import_app {seconds:.2f} s (budget {STARTUP_BUDGET_SECONDS:.2f} s)")
+        found = startup_regressions(seconds)
+        for line in found:
+            print(f"REGRESSION {line}")
+        sys.exit(1 if found else 0)
+
+    results = run_benchmarks([int(scale) for scale in args.scales.split(',')])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Baseline written to {args.baseline}")
+        sys.exit(0)
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --update-baseline first")
+        sys.exit(1)
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    found = regressions(results, baseline, args.tolerance)
+    for line in found:
+        print(f"REGRESSION {line}")
+    print(f"{len(found)} regression(s) beyond {args.tolerance:.0%} tolerance")
+    sys.exit(1 if found else 0)
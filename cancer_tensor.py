@@ -0,0 +1,86 @@
+import numpy as np
+
+# Columns of a long-format cancer upload, one row per city, cancer type and year
+LONG_COLUMNS = ['City', 'State', 'Year', 'CancerType', 'Count']
+
+# Axis names of the tensor, in storage order
+AXES = ('city', 'cancer_type', 'year')
+
+def is_long_format(columns):
+    """Tell whether cancer data columns are LONG_COLUMNS, ignoring case"""
+    return [str(col).lower() for col in columns] == [col.lower() for col in LONG_COLUMNS]
+
+class CancerTensor:
+    """Case counts indexed by city x cancer type x year
+
+    Counts are stored sparsely as one coordinate per record, so the tensor
+    grows with the number of records rather than with the product of its
+    axes. Aggregate views are sums over axes, computed with np.bincount.
+    """
+
+    def __init__(self, cities, states, cancer_types, years, city, cancer_type, year, counts):
+        self.cities = np.asarray(cities, dtype=str)
+        self.states = np.asarray(states, dtype=str)
+        self.cancer_types = np.asarray(cancer_types, dtype=str)
+        self.years = np.asarray(years, dtype=np.int64)
+        self.coords = {
+            'city': np.asarray(city, dtype=np.int64),
+            'cancer_type': np.asarray(cancer_type, dtype=np.int64),
+            'year': np.asarray(year, dtype=np.int64)
+        }
+        self.counts = np.asarray(counts)
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Build a tensor from the arrays stored by ingest.convert_upload
+
+        cities, states, cancer_types and years label the axes; coord_city,
+        coord_cancer_type, coord_year and counts hold one entry per record,
+        and repeated records are summed.
+        """
+        return cls(
+            arrays['cities'], arrays['states'], arrays['cancer_types'], arrays['years'],
+            arrays['coord_city'], arrays['coord_cancer_type'], arrays['coord_year'], arrays['counts']
+        )
+
+    @property
+    def shape(self):
+        return (len(self.cities), len(self.cancer_types), len(self.years))
+
+    def reduce(self, *keep, cities=None):
+        """Sum the counts over every axis not named in keep, returning a dense array
+
+        The result has one dimension per kept axis, in AXES order. cities, a
+        boolean mask over the city axis, limits the sums to those cities.
+        """
+        keep = [axis for axis in AXES if axis in keep]
+        sizes = dict(zip(AXES, self.shape))
+        counts, coords = self.counts, self.coords
+        if cities is not None:
+            selected = np.asarray(cities, dtype=bool)[coords['city']]
+            counts = counts[selected]
+            coords = {axis: values[selected] for axis, values in coords.items()}
+        flat = np.zeros(len(counts), dtype=np.int64)
+        for axis in keep:
+            flat = flat * sizes[axis] + coords[axis]
+        length = int(np.prod([sizes[axis] for axis in keep]))
+        totals = np.bincount(flat, weights=counts, minlength=length)
+        if counts.dtype.kind in 'iub':
+            totals = totals.round().astype(np.int64)
+        return totals.reshape([sizes[axis] for axis in keep])
+
+    def to_wide(self):
+        """Return the wide layout that is merged with the census and drawn on the maps
+
+        One row per city with City and State, a total per cancer type and a
+        total per year, the year columns named by the year as text.
+        """
+        import pandas as pd
+        columns = {'City': self.cities.astype(object), 'State': self.states.astype(object)}
+        by_type = self.reduce('city', 'cancer_type')
+        for i, name in enumerate(self.cancer_types.tolist()):
+            columns[name] = by_type[:, i]
+        by_year = self.reduce('city', 'year')
+        for i, year in enumerate(self.years.tolist()):
+            columns[str(year)] = by_year[:, i]
+        return pd.DataFrame(columns)
@@ -0,0 +1,241 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from matching import MATCHER_VERSION, CityMatcher, index_arrays
+import spatial
+
+# Census of US places shipped with the app
+CENSUS_FILE = 'processed_census_data.csv'
+
+# Columns carried over from processed_census_data.csv into merged frames
+CENSUS_COLUMNS = ['city', 'state_id', 'county_name', 'lat', 'lng', 'population']
+
+# String columns are stored dictionary-encoded as <name>_codes.npy + <name>_values.npy
+STRING_COLUMNS = ['city', 'state_id', 'county_name']
+
+# Bump when the on-disk layout of the compiled cache changes
+CACHE_FORMAT = 3
+
+# Prefix of the precomputed CityMatcher arrays stored with the census columns
+MATCH_PREFIX = 'match_'
+CACHE_DIRNAME = 'census_cache'
+
+# One gazetteer per census file per process, reloaded when the file changes
+_gazetteers = {}
+
+def file_checksum(path):
+    """Return the SHA-256 hex digest of a file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _stat_signature(path):
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+def cache_dir_for(csv_path):
+    """Return the directory holding compiled caches for a census CSV"""
+    return os.path.join(os.path.dirname(os.path.abspath(csv_path)), CACHE_DIRNAME)
+
+def compile_census(csv_path):
+    """Parse the census CSV into typed, dictionary-encoded NumPy columns and the city matching index"""
+    import pandas as pd
+    census = pd.read_csv(csv_path, usecols=CENSUS_COLUMNS, dtype={
+        'city': str, 'state_id': str, 'county_name': str,
+        'lat': np.float64, 'lng': np.float64, 'population': np.int64
+    })
+
+    arrays = {
+        'lat': census['lat'].to_numpy(dtype=np.float32),
+        'lng': census['lng'].to_numpy(dtype=np.float32),
+        # float32 cannot hold the largest populations exactly, int32 can
+        'population': census['population'].to_numpy(dtype=np.int32)
+    }
+    for col in STRING_COLUMNS:
+        codes, values = pd.factorize(census[col])
+        arrays[f'{col}_codes'] = codes.astype(np.int32)
+        arrays[f'{col}_values'] = np.asarray(values, dtype=str)
+    for name, array in index_arrays(census['city'].to_numpy(), census['state_id'].to_numpy()).items():
+        arrays[MATCH_PREFIX + name] = array
+    return arrays
+
+def build_cache(csv_path, checksum=None):
+    """Compile the census CSV into a checksum-named cache directory and return its path"""
+    checksum = checksum or file_checksum(csv_path)
+    root = cache_dir_for(csv_path)
+    # The matching index is rebuilt whenever its rules change
+    name = f'v{CACHE_FORMAT}-m{MATCHER_VERSION}-{checksum}'
+    target = os.path.join(root, name)
+    if os.path.exists(os.path.join(target, 'manifest.json')):
+        return target
+
+    os.makedirs(root, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix='.build-', dir=root)
+    try:
+        arrays = compile_census(csv_path)
+        for column, array in arrays.items():
+            np.save(os.path.join(staging, f'{column}.npy'), array, allow_pickle=False)
+        try:
+            spatial.save_tree(spatial.build_tree(arrays['lat'], arrays['lng']), staging)
+        except ImportError as e:
+            # Without scipy only the nearest-place and radius queries are unavailable
+            print(f"Could not build the census KD-tree: {e}")
+        with open(os.path.join(staging, 'manifest.json'), 'w') as f:
+            json.dump({
+                'format': CACHE_FORMAT,
+                'source': os.path.basename(csv_path),
+                'checksum': checksum,
+                'rows': int(len(arrays['lat']))
+            }, f)
+        # Another worker may have published the same checksum first
+        try:
+            os.rename(staging, target)
+        except OSError:
+            if not os.path.exists(os.path.join(target, 'manifest.json')):
+                raise
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    # Drop caches compiled from earlier versions of the CSV; processes that still
+    # have them memory-mapped keep their pages until they reload
+    for entry in os.listdir(root):
+        if entry != name and not entry.startswith('.'):
+            shutil.rmtree(os.path.join(root, entry), ignore_errors=True)
+    return target
+
+def load_cache(cache_dir):
+    """Memory-map the arrays of a compiled cache directory"""
+    with open(os.path.join(cache_dir, 'manifest.json')) as f:
+        manifest = json.load(f)
+    if manifest.get('format') != CACHE_FORMAT:
+        raise ValueError(f"Unsupported census cache format in {cache_dir}")
+
+    arrays = {}
+    for filename in os.listdir(cache_dir):
+        if filename.endswith('.npy'):
+            arrays[filename[:-4]] = np.load(os.path.join(cache_dir, filename), mmap_mode='r')
+    return manifest, arrays
+
+class Gazetteer:
+    """Census places held as typed NumPy columns, matched to uploads by a CityMatcher"""
+
+    def __init__(self, path, arrays, version=None, cache_dir=None):
+        self.path = path
+        self.version = version
+        self.signature = None
+        self.cache_dir = cache_dir
+        self.arrays = arrays
+        self.lat = arrays['lat']
+        self.lng = arrays['lng']
+        self.population = arrays['population']
+        self._places = None
+
+        # The looser indexes are precomputed with the cache and only loaded on first use
+        self.matcher = CityMatcher(self.decode('city'), self.decode('state_id'), {
+            name[len(MATCH_PREFIX):]: array for name, array in arrays.items() if name.startswith(MATCH_PREFIX)
+        } or None)
+
+    @classmethod
+    def from_csv(cls, path):
+        """Load the gazetteer through its compiled cache, rebuilding it if the CSV changed"""
+        signature = _stat_signature(path)
+        checksum = file_checksum(path)
+        try:
+            cache_dir = build_cache(path, checksum)
+            _, arrays = load_cache(cache_dir)
+        except OSError as e:
+            # Read-only checkouts still work, just without sharing pages between workers
+            print(f"Could not use census cache for {path}: {e}")
+            cache_dir = None
+            arrays = compile_census(path)
+        gazetteer = cls(path, arrays, version=checksum, cache_dir=cache_dir)
+        gazetteer.signature = signature
+        return gazetteer
+
+    def __len__(self):
+        return len(self.lat)
+
+    def decode(self, column, rows=None):
+        """Return the strings of a dictionary-encoded column, optionally for some rows"""
+        codes = self.arrays[f'{column}_codes']
+        if rows is not None:
+            codes = codes[rows]
+        return self.arrays[f'{column}_values'][codes].astype(object)
+
+    @property
+    def places(self):
+        """The spatial index over census coordinates, loaded from the cache or built on first use"""
+        if self._places is None:
+            tree = spatial.load_tree(self.cache_dir) if self.cache_dir else None
+            self._places = spatial.PlaceIndex(tree or spatial.build_tree(self.lat, self.lng))
+        return self._places
+
+    def lookup(self, cities, states):
+        """Return census row numbers for each (city, state) pair, -1 where unmatched"""
+        return self.matcher.match(cities, states)[0]
+
+    def columns(self, rows):
+        """Return the census columns for the given row numbers as a DataFrame"""
+        import pandas as pd
+        return pd.DataFrame({
+            'city': self.decode('city', rows),
+            'state_id': self.decode('state_id', rows),
+            'county_name': self.decode('county_name', rows),
+            # Undo float32 noise; the census carries coordinates to 4 decimals
+            'lat': self.lat[rows].astype(np.float64).round(5),
+            'lng': self.lng[rows].astype(np.float64).round(5),
+            'population': self.population[rows].astype(np.int64)
+        })
+
+    def merge(self, data, city_col='City', state_col='State'):
+        """Inner-join uploaded rows with the census, keeping the upload's row order
+
+        Returns the merged frame and a frame describing how every uploaded row
+        was matched: its city and state, the match method (see
+        matching.MATCH_METHODS), the census place it matched and the score.
+        """
+        import pandas as pd
+        rows, methods, scores = self.matcher.match(data[city_col].to_numpy(), data[state_col].to_numpy())
+        matched = rows >= 0
+        left = data.loc[matched].reset_index(drop=True)
+        right = self.columns(rows[matched])
+
+        census_city = np.full(len(rows), None, dtype=object)
+        census_state = np.full(len(rows), None, dtype=object)
+        census_city[matched] = right['city'].to_numpy()
+        census_state[matched] = right['state_id'].to_numpy()
+        matches = pd.DataFrame({
+            'City': data[city_col].to_numpy(),
+            'State': data[state_col].to_numpy(),
+            'Match': methods,
+            'CensusCity': census_city,
+            'CensusState': census_state,
+            'Score': scores.round(3)
+        })
+        return pd.concat([left, right], axis=1), matches
+
+def get_gazetteer(path):
+    """Return the process-wide gazetteer for path, reloading it if the file changed"""
+    path = os.path.abspath(path)
+    signature = _stat_signature(path)
+
+    gazetteer = _gazetteers.get(path)
+    if gazetteer is not None and gazetteer.signature != signature:
+        # Touched files with identical content keep the loaded gazetteer
+        if file_checksum(path) == gazetteer.version:
+            gazetteer.signature = signature
+        else:
+            gazetteer = None
+    if gazetteer is None:
+        gazetteer = Gazetteer.from_csv(path)
+        _gazetteers[path] = gazetteer
+    return gazetteer
+
+# Compile the cache ahead of time, e.g. while building the Docker image
+if __name__ == "__main__":
+    print(build_cache(CENSUS_FILE))
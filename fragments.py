@@ -0,0 +1,99 @@
+import json
+import re
+from artifacts import publish
+from assets import asset_url, plotly_cdn_url, rewrite_urls, vendored_version
+from spans import span
+from workspaces import atomic_output, atomic_write
+
+# Artifacts written with this suffix are fragments to inline into the single-page
+# report instead of standalone HTML documents
+FRAGMENT_SUFFIX = '.json'
+
+# Folium header entries left out of fragments: page-level styles, and Bootstrap,
+# which the maps do not use but whose stylesheets restyle the report's layout
+MAP_PAGE_HEADERS = ('meta_http', 'css_style', 'map_style', 'bootstrap', 'bootstrap_css', 'glyphicons_css')
+
+# Each map's own header entry opens with a viewport tag that would stop the report from zooming
+VIEWPORT_META = re.compile(r'<meta\s+name="viewport"[^>]*>\s*', re.IGNORECASE)
+
+def is_fragment(output_file):
+    return output_file.endswith(FRAGMENT_SUFFIX)
+
+def _script_safe(payload):
+    """Escape a JSON string so it can be inlined into a <script> element"""
+    return payload.replace('</', '<\\/')
+
+def save_figure(fig, output_file, config):
+    """Write a plotly figure as a standalone page, or as a fragment holding its JSON"""
+    with span('save', output=output_file):
+        _save_figure(fig, output_file, config)
+    return output_file
+
+def _save_figure(fig, output_file, config):
+    if is_fragment(output_file):
+        atomic_write(output_file, '{"kind": "plotly", "config": %s, "figure": %s}' % (
+            json.dumps(dict(config, responsive=True)), fig.to_json()
+        ))
+    else:
+        import plotly.io as pio
+        # Load plotly.js from the app when it is vendored, otherwise from its CDN
+        include_plotlyjs = asset_url(plotly_cdn_url()) if vendored_version() else 'cdn'
+        with atomic_output(output_file) as temp_file:
+            pio.write_html(fig, file=temp_file, full_html=True, include_plotlyjs=include_plotlyjs, config=config)
+        publish(output_file)
+
+def save_map(m, output_file):
+    """Write a folium map as a standalone page, or as a fragment of its head, body and script parts
+
+    A fragment keeps every head entry as a separate string so that libraries
+    shared by several maps are loaded only once by the report. Either way,
+    vendored libraries are loaded from the app instead of their CDNs.
+    """
+    with span('save', output=output_file):
+        _save_map(m, output_file)
+    return output_file
+
+def _save_map(m, output_file):
+    root = m.get_root()
+    if is_fragment(output_file):
+        root.render()
+        atomic_write(output_file, json.dumps({
+            'kind': 'folium',
+            'header': [
+                rewrite_urls(VIEWPORT_META.sub('', child.render())) for name, child in root.header._children.items()
+                if name not in MAP_PAGE_HEADERS
+            ],
+            'html': root.html.render(),
+            'script': root.script.render()
+        }))
+    else:
+        atomic_write(output_file, rewrite_urls(root.render()).encode('utf8'))
+        publish(output_file)
+
+def load_fragment(path):
+    with open(path) as f:
+        return json.load(f)
+
+def fragment_body(fragment, element_id):
+    """Return the HTML that draws a fragment inside the report"""
+    if fragment['kind'] == 'folium':
+        return fragment['html']
+    return f'<div id="{element_id}" class="plotly-chart"></div>'
+
+def fragment_script(fragment, element_id):
+    """Return the JavaScript that draws a fragment once the page has loaded"""
+    if fragment['kind'] == 'folium':
+        return fragment['script']
+    figure = dict(fragment['figure'], config=fragment['config'])
+    return "Plotly.newPlot(%s, %s);" % (json.dumps(element_id), _script_safe(json.dumps(figure)))
+
+def fragment_headers(fragments):
+    """Return the head entries needed by all fragments, each library included once"""
+    headers = []
+    if any(fragment['kind'] == 'plotly' for fragment in fragments):
+        headers.append(f'<script src="{asset_url(plotly_cdn_url())}" charset="utf-8"></script>')
+    for fragment in fragments:
+        for header in fragment.get('header', []):
+            if header not in headers:
+                headers.append(header)
+    return headers
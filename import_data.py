@@ -1,29 +1,124 @@
-import pandas as pd
-import folium
-from folium.plugins import HeatMap
-import plotly.graph_objs as go
-import plotly.io as pio
+import multiprocessing
 import os
-import numpy as np
-import json
-import matplotlib.pyplot as plt
-import base64
-from io import BytesIO
-
-def generate_visualization(uploads_folder="uploads"):
-    """Generate visualizations based on uploaded data files"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import artifacts
+import ingest
+import metrics
+from assets import vendored_version
+from census import file_checksum, get_gazetteer
+from matching import MATCH_METHODS, MATCHER_VERSION
+from fragments import (
+    FRAGMENT_SUFFIX, fragment_body, fragment_headers, fragment_script, is_fragment, load_fragment, save_figure,
+    save_map
+)
+import render_cache
+import spans
+from aggregation import HEAT_GRID_MODES, build_pyramid, heat_points, save_pyramid
+from workspaces import atomic_output, atomic_write
+
+# File written by each rendering stage
+OUTPUT_FILES = {
+    'population_map': 'population_map.html',
+    'cancer_map': 'cancer_map.html',
+    'race_demographics': 'race_demographics.html',
+    'age_distribution': 'age_distribution.html',
+    'cancer_trends': 'cancer_trends.html',
+    'cancer_distribution': 'cancer_distribution.html'
+}
+
+# Uploaded file each rendering stage is derived from
+STAGE_INPUTS = {
+    'population_map': 'cancer',
+    'cancer_map': 'cancer',
+    'cancer_trends': 'cancer',
+    'cancer_distribution': 'cancer',
+    'age_distribution': 'ageSex',
+    'race_demographics': 'countyRace'
+}
+
+# Combined report linking every rendered artifact
+REPORT_FILE = 'custom_cancer_map_v12_4.html'
+
+# 'single' inlines every map and chart into the report, loading each library
+# once; 'iframes' embeds the standalone page of each artifact
+REPORT_MODES = ('single', 'iframes')
+
+# Heat layer settings shared by both maps; HEAT_MAX_ZOOM also sets the binning resolution
+HEAT_RADIUS = 55
+HEAT_BLUR = 15
+HEAT_MAX_ZOOM = 13
+
+# Maps with more points than this fetch their heat layer from HEAT_API_URL when
+# heat_source is 'auto'. The pyramid behind it is stored in the render cache
+# under a key derived from the dataset, which maps request as HEAT_API_URL/<key>,
+# so every report of a dataset shares it whichever session views it
+HEAT_API_THRESHOLD = 20000
+HEAT_SOURCES = ('auto', 'embedded', 'api')
+HEAT_API_URL = '/api/heat'
+PYRAMID_SUFFIX = '.pyramid.npz'
+
+# Uploaded cancer rows that did not match a census place exactly, written
+# next to the report so they can be checked and corrected
+MATCH_REPORT_FILE = 'match_report.csv'
+
+# City markers on the incidence map are clustered above this many cities
+CLUSTER_THRESHOLD = 1000
+MARKER_MODES = ('auto', 'markers', 'cluster')
+
+# Above this many cities the trend chart draws only the TREND_TOP_CITIES cities
+# with the most cases as separate lines, and every other city in one WebGL trace
+TREND_TRACE_THRESHOLD = 50
+TREND_TOP_CITIES = 20
+
+# Imported by the fork server that starts render workers (see render_context)
+RENDER_PRELOAD_MODULES = ['import_data', 'folium', 'folium.plugins', 'plotly.graph_objs', 'map_layers']
+
+# Stages reported through the progress callback of generate_visualization
+VISUALIZATION_STAGES = [
+    'merge', 'heat_pyramid', 'population_map', 'cancer_map', 'age_distribution',
+    'race_demographics', 'cancer_trends', 'cancer_distribution', 'report'
+]
+
+def generate_visualization(uploads_folder="uploads", output_folder=".", progress=None, workers=None,
+                           marker_mode='auto', heat_grid='auto', heat_source='auto', report_mode='single',
+                           use_render_cache=True):
+    """Generate visualizations based on uploaded data files, writing them to output_folder
+
+    progress, if given, is called as progress(stage, status) with a stage from
+    VISUALIZATION_STAGES and a status of 'running', 'done' or 'failed'.
+    workers is the number of processes rendering maps and charts concurrently
+    (see render_worker_count). marker_mode selects how cities are drawn on the
+    incidence map (see create_cancer_incidence_map) and heat_grid whether heat
+    points are binned on the server (see aggregation.heat_points). heat_source
+    is 'embedded' to put heat points into the maps, 'api' to have the maps load
+    them from HEAT_API_URL, or 'auto' to choose by HEAT_API_THRESHOLD.
+    report_mode is one of REPORT_MODES; in 'single' mode the stages write
+    fragments instead of standalone pages. use_render_cache=False renders
+    every stage even if the render cache holds it, as when profiling.
+    """
+    if progress is None:
+        progress = lambda stage, status: None
+
+    # The data and rendering libraries are imported on first use, keeping app start-up fast
+    import folium
+    import plotly
+
     try:
-        # Clear any existing visualization files
-        viz_files = [
-            'population_map.html', 'cancer_map.html', 'race_demographics.html',
-            'age_distribution.html', 'cancer_trends.html', 'cancer_distribution.html',
-            'custom_cancer_map_v12_4.html'
+        # Clear any existing visualization files; unchanged ones are restored from the render cache
+        outputs = {stage: os.path.join(output_folder, name) for stage, name in OUTPUT_FILES.items()}
+        fragments = {
+            stage: os.path.splitext(output_file)[0] + FRAGMENT_SUFFIX for stage, output_file in outputs.items()
+        }
+        viz_files = list(outputs.values()) + list(fragments.values()) + [
+            os.path.join(output_folder, REPORT_FILE), os.path.join(output_folder, MATCH_REPORT_FILE)
         ]
+        if report_mode == 'single':
+            outputs = fragments
         
         for file in viz_files:
             if os.path.exists(file):
                 try:
-                    os.remove(file)
+                    artifacts.remove(file)
                 except Exception as e:
                     print(f"Error removing existing visualization file {file}: {e}")
 
@@ -38,7 +133,9 @@ def generate_visualization(uploads_folder="uploads"):
         if not any(uploaded_files.values()):
             print("No data files were uploaded. Cannot generate visualizations.")
             # Still create the HTML with a message
-            generate_html_output(None, None, [], {})
+            progress('report', 'running')
+            generate_html_output(None, None, [], {}, output_folder, report_mode)
+            progress('report', 'done')
             return True
 
         # Dictionary to track successfully created visualizations
@@ -51,9 +148,8 @@ def generate_visualization(uploads_folder="uploads"):
             'cancer_distribution': False
         }
 
-        population_map = None
-        cancer_map = None
-        extra_charts = []
+        # Independent rendering tasks as (stage, function, arguments, label)
+        render_tasks = []
 
         # Process census data to get city, state, lat, lng, population
         census_data_path = os.path.join(uploads_folder, 'processed_census_data.csv')
@@ -64,84 +160,206 @@ def generate_visualization(uploads_folder="uploads"):
                 print("Processed census data not found. Please ensure uscities.csv is processed.")
                 return False
 
-        census_data = pd.read_csv(census_data_path)
+        # Loaded once per process and reused until the census file changes
+        with spans.span('census'):
+            gazetteer = get_gazetteer(census_data_path)
+
+        # Artifacts and heat pyramids are cached under the hashes of their inputs
+        input_hashes = {
+            file_type: [file_checksum(os.path.join(uploads_folder, f'{file_type}_data.csv'))]
+            for file_type, exists in uploaded_files.items() if exists
+        }
+        if 'cancer' in input_hashes:
+            input_hashes['cancer'] += [gazetteer.version, MATCHER_VERSION]
+        heat_url = None
 
         # Only process cancer data if it exists
         if uploaded_files['cancer']:
             try:
-                cancer_data = pd.read_csv(os.path.join(uploads_folder, 'cancer_data.csv'))
+                progress('merge', 'running')
+                cancer_path = os.path.join(uploads_folder, 'cancer_data.csv')
+                with spans.span('load:cancer'):
+                    schema = ingest.converted_schema(cancer_path, 'cancer')
+                    if schema['format'] == 'long':
+                        # The charts sum long-format records over the tensor's axes,
+                        # the maps draw its per-city totals
+                        tensor = ingest.load_tensor(cancer_path)
+                        cancer_data = tensor.to_wide()
+                    else:
+                        tensor = None
+                        cancer_data, _ = ingest.load_upload(cancer_path, 'cancer')
                 
-                # Identify cancer type columns (non-year columns)
-                cancer_cols = [col for col in cancer_data.columns[2:] if not str(col).isdigit()]
-                year_cols = [col for col in cancer_data.columns[2:] if str(col).isdigit()]
+                # Cancer type and year columns were identified when the file was ingested
+                cancer_cols = schema['cancer_cols']
+                year_cols = schema['year_cols']
                 
                 # Merge cancer data with census data
-                merged_data = pd.merge(
-                    cancer_data,
-                    census_data,
-                    left_on=['City', 'State'],
-                    right_on=['city', 'state_id'],
-                    how='inner'
-                )
+                with spans.span('merge'):
+                    merged_data, matches = gazetteer.merge(cancer_data)
+                counts = matches['Match'].value_counts()
+                for method in MATCH_METHODS:
+                    metrics.inc('oncocontour_merge_rows_total', int(counts.get(method, 0)), result=method)
+                
+                # Rows that needed normalizing or fuzzy matching, or matched nothing, are listed for review
+                loose = matches[matches['Match'] != 'exact']
+                if not loose.empty:
+                    with atomic_output(os.path.join(output_folder, MATCH_REPORT_FILE)) as temp_file:
+                        loose.to_csv(temp_file, index=False)
+                    print(
+                        f"Matched {len(merged_data)} of {len(matches)} cancer data rows "
+                        f"({int(counts.get('normalized', 0))} normalized, {int(counts.get('fuzzy', 0))} fuzzy); "
+                        f"{int(counts.get('unmatched', 0))} unmatched, see {MATCH_REPORT_FILE}"
+                    )
+                progress('merge', 'done')
+                
+                if heat_source == 'auto':
+                    heat_source = 'api' if len(merged_data) > HEAT_API_THRESHOLD else 'embedded'
                 
+                # Large maps load their heat layer on demand from a precomputed pyramid,
+                # which is only built when the render cache does not already hold it
+                if heat_source == 'api' and not merged_data.empty:
+                    progress('heat_pyramid', 'running')
+                    pyramid_key = render_cache.cache_key(
+                        'heat_pyramid', input_hashes['cancer'], {'radius': HEAT_RADIUS}
+                    )
+                    heat_url = f'{HEAT_API_URL}/{pyramid_key}'
+                    if render_cache.lookup(pyramid_key, PYRAMID_SUFFIX):
+                        metrics.inc('oncocontour_render_cache_total', result='hit')
+                    else:
+                        metrics.inc('oncocontour_render_cache_total', result='miss')
+                        with spans.span('heat_pyramid') as current:
+                            current['output'] = render_cache.add(
+                                pyramid_key, PYRAMID_SUFFIX,
+                                lambda path: save_pyramid(path, heat_pyramid(merged_data, cancer_cols))
+                            )
+                    progress('heat_pyramid', 'done')
+                
+                # Each task only receives the columns it reads, so worker
+                # processes are not sent the whole merged frame every time
                 if not merged_data.empty:
-                    # Create population heatmap
-                    population_map = create_population_heatmap(merged_data)
-                    created_visualizations['population_map'] = True
-                    print("Population map created successfully")
-                    
-                    # Create cancer incidence map
+                    render_tasks.append((
+                        'population_map', create_population_heatmap,
+                        (merged_data[['lat', 'lng', 'population']], outputs['population_map'], heat_grid, heat_url),
+                        'Population map'
+                    ))
                     if cancer_cols:
-                        cancer_map = create_cancer_incidence_map(merged_data, cancer_cols)
-                        created_visualizations['cancer_map'] = True
-                        print("Cancer incidence map created successfully")
+                        render_tasks.append((
+                            'cancer_map', create_cancer_incidence_map,
+                            (merged_data[['City', 'State', 'lat', 'lng', 'population'] + cancer_cols], cancer_cols,
+                             outputs['cancer_map'], marker_mode, heat_grid, heat_url),
+                            'Cancer incidence map'
+                        ))
+                
+                # The charts count the cities matched to the census, as the maps do
+                if tensor is not None:
+                    # Tensor cities are the rows of its wide layout, so they line up with matches
+                    matched = (matches['Match'] != 'unmatched').to_numpy()
+                    trend_cities = tensor.cities[matched]
+                    trend_counts = tensor.reduce('city', 'year')[matched]
+                    type_totals = tensor.reduce('cancer_type', cities=matched)
+                else:
+                    trend_cities = merged_data['City'].to_numpy()
+                    trend_counts = merged_data[year_cols].to_numpy()
+                    type_totals = merged_data[cancer_cols].to_numpy().sum(axis=0)
+                
+                # Only process cancer trends if year columns are present
+                if year_cols:
+                    render_tasks.append((
+                        'cancer_trends', create_trend_analysis,
+                        (trend_cities, [int(year) for year in year_cols], trend_counts, outputs['cancer_trends']),
+                        'Cancer trends chart'
+                    ))
+                
+                # Only process cancer distribution if cancer columns are present
+                if cancer_cols:
+                    render_tasks.append((
+                        'cancer_distribution', create_cancer_distribution_chart,
+                        (cancer_cols, type_totals, outputs['cancer_distribution']),
+                        'Cancer distribution chart'
+                    ))
             except Exception as e:
+                progress('merge', 'failed')
                 print(f"Error processing cancer data: {str(e)}")
 
         # Only process age/sex data if it exists
         if uploaded_files['ageSex']:
             try:
-                age_sex_data = pd.read_csv(os.path.join(uploads_folder, 'ageSex_data.csv'))
-                age_chart = create_age_distribution_chart(age_sex_data)
-                extra_charts.append(age_chart)
-                created_visualizations['age_distribution'] = True
-                print("Age distribution chart created successfully")
+                with spans.span('load:ageSex'):
+                    age_sex_data, _ = ingest.load_upload(os.path.join(uploads_folder, 'ageSex_data.csv'), 'ageSex')
+                render_tasks.append((
+                    'age_distribution', create_age_distribution_chart,
+                    (age_sex_data, outputs['age_distribution']), 'Age distribution chart'
+                ))
             except Exception as e:
+                progress('age_distribution', 'failed')
                 print(f"Error creating age distribution chart: {str(e)}")
 
         # Only process county race data if it exists
         if uploaded_files['countyRace']:
             try:
-                county_race_data = pd.read_csv(os.path.join(uploads_folder, 'countyRace_data.csv'))
-                race_chart = create_race_demographics_chart(county_race_data)
-                extra_charts.append(race_chart)
-                created_visualizations['race_demographics'] = True
-                print("Race demographics chart created successfully")
+                with spans.span('load:countyRace'):
+                    county_race_data, _ = ingest.load_upload(
+                        os.path.join(uploads_folder, 'countyRace_data.csv'), 'countyRace'
+                    )
+                render_tasks.append((
+                    'race_demographics', create_race_demographics_chart,
+                    (county_race_data, outputs['race_demographics']), 'Race demographics chart'
+                ))
             except Exception as e:
+                progress('race_demographics', 'failed')
                 print(f"Error creating race demographics chart: {str(e)}")
 
-        # Only process cancer trends if cancer data exists and year columns are present
-        if uploaded_files['cancer'] and year_cols:
-            try:
-                trend_chart = create_trend_analysis(merged_data, year_cols)
-                extra_charts.append(trend_chart)
-                created_visualizations['cancer_trends'] = True
-                print("Cancer trends chart created successfully")
-            except Exception as e:
-                print(f"Error creating cancer trends chart: {str(e)}")
+        # Artifacts whose inputs are unchanged are copied back from the render cache
+        render_params = {'folium': folium.__version__, 'plotly': plotly.__version__, 'assets': vendored_version()}
+        stage_params = {
+            'population_map': {'heat_grid': heat_grid, 'heat_source': heat_source},
+            'cancer_map': {'marker_mode': marker_mode, 'heat_grid': heat_grid, 'heat_source': heat_source}
+        }
+
+        cache_keys = {}
+        cached = {}
+        tasks_to_render = []
+        for task in render_tasks:
+            stage, label = task[0], task[3]
+            params = dict(render_params, **stage_params.get(stage, {}))
+            cache_keys[stage] = render_cache.cache_key(stage, input_hashes[STAGE_INPUTS[stage]], params)
+            if use_render_cache and render_cache.fetch(cache_keys[stage], outputs[stage]):
+                if not is_fragment(outputs[stage]):
+                    artifacts.publish(outputs[stage])
+                cached[stage] = outputs[stage]
+                metrics.inc('oncocontour_render_cache_total', result='hit')
+                progress(stage, 'done')
+                print(f"{label} restored from render cache")
+            else:
+                metrics.inc('oncocontour_render_cache_total', result='miss')
+                tasks_to_render.append(task)
 
-        # Only process cancer distribution if cancer data exists and cancer columns are present
-        if uploaded_files['cancer'] and cancer_cols:
+        rendered = run_render_tasks(tasks_to_render, workers, progress)
+        for stage, output_file in rendered.items():
             try:
-                dist_chart = create_cancer_distribution_chart(merged_data, cancer_cols)
-                extra_charts.append(dist_chart)
-                created_visualizations['cancer_distribution'] = True
-                print("Cancer distribution chart created successfully")
-            except Exception as e:
-                print(f"Error creating cancer distribution chart: {str(e)}")
+                render_cache.store(cache_keys[stage], output_file)
+            except OSError as e:
+                print(f"Error caching {output_file}: {e}")
+        rendered.update(cached)
+
+        for stage in rendered:
+            created_visualizations[stage] = True
+
+        population_map = rendered.get('population_map')
+        cancer_map = rendered.get('cancer_map')
+        extra_charts = [
+            rendered[stage] for stage in
+            ('age_distribution', 'race_demographics', 'cancer_trends', 'cancer_distribution')
+            if stage in rendered
+        ]
 
         # Generate the final HTML output
-        generate_html_output(population_map, cancer_map, extra_charts, created_visualizations)
+        progress('report', 'running')
+        with spans.span('report', output=os.path.join(output_folder, REPORT_FILE)):
+            generate_html_output(
+                population_map, cancer_map, extra_charts, created_visualizations, output_folder, report_mode
+            )
+        progress('report', 'done')
         
         return True
         
@@ -149,8 +367,111 @@ def generate_visualization(uploads_folder="uploads"):
         print(f"Error generating visualizations: {str(e)}")
         return False
 
-def create_population_heatmap(city_data):
-    """Create a heatmap showing city populations"""
+def render_worker_count(workers=None, tasks=None):
+    """Resolve how many processes render in parallel
+
+    Defaults to ONCOCONTOUR_RENDER_WORKERS, or the CPU count if that is unset,
+    and never exceeds the number of tasks. A count of 1 renders in-process.
+    """
+    if workers is None:
+        workers = int(os.environ.get('ONCOCONTOUR_RENDER_WORKERS', os.cpu_count() or 1))
+    if tasks is not None:
+        workers = min(workers, tasks)
+    return max(workers, 1)
+
+def render_context():
+    """Return the multiprocessing context render workers are started with
+
+    Workers come from a fork server rather than being forked from the calling
+    process, whose other threads (job heartbeats, workspace GC, the metrics
+    flusher) may hold a lock at fork time. The server preloads the rendering
+    libraries once, so each worker starts with them already imported.
+    """
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(RENDER_PRELOAD_MODULES)
+    return context
+
+def run_render_tasks(render_tasks, workers=None, progress=None):
+    """Run independent rendering tasks, in parallel when more than one worker is allowed
+
+    Returns a dict mapping each successful task's stage to the file it wrote.
+    A failing task is reported and skipped without affecting the others.
+    """
+    if progress is None:
+        progress = lambda stage, status: None
+
+    rendered = {}
+    workers = render_worker_count(workers, len(render_tasks))
+
+    if workers == 1:
+        for stage, func, args, label in render_tasks:
+            progress(stage, 'running')
+            try:
+                rendered[stage], recorded = render_traced(stage, func, args)
+                spans.record(recorded)
+                progress(stage, 'done')
+                print(f"{label} created successfully")
+            except Exception as e:
+                progress(stage, 'failed')
+                print(f"Error creating {label.lower()}: {str(e)}")
+        return rendered
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=render_context()) as pool:
+        futures = {}
+        for stage, func, args, label in render_tasks:
+            futures[pool.submit(render_traced, stage, func, args)] = (stage, label)
+            progress(stage, 'running')
+
+        # The slowest chart bounds the wall time instead of the sum of all of them
+        for future in as_completed(futures):
+            stage, label = futures[future]
+            try:
+                rendered[stage], recorded = future.result()
+                spans.record(recorded)
+                progress(stage, 'done')
+                print(f"{label} created successfully")
+            except Exception as e:
+                progress(stage, 'failed')
+                print(f"Error creating {label.lower()}: {str(e)}")
+    return rendered
+
+def render_traced(stage, func, args):
+    """Run a rendering task in a span, returning its output file and the spans recorded while it ran
+
+    Worker processes cannot add to the caller's collector, so their spans
+    travel back with the result.
+    """
+    with spans.collect() as recorded:
+        with spans.span(stage) as current:
+            current['output'] = func(*args)
+    return current['output'], recorded
+
+def cancer_totals(merged_data, cancer_cols):
+    """Return total cancer cases and cases per 1,000 residents for each city"""
+    total_cancer = merged_data[cancer_cols].sum(axis=1)
+    return total_cancer, (total_cancer / merged_data['population']) * 1000
+
+def heat_pyramid(merged_data, cancer_cols):
+    """Build the pyramid that HEAT_API_URL serves the population and cancer heat layers from"""
+    total_cancer, cancer_rate = cancer_totals(merged_data, cancer_cols)
+    return build_pyramid(
+        merged_data['lat'], merged_data['lng'],
+        {'population': merged_data['population'], 'TotalCancer': total_cancer, 'CancerRate': cancer_rate},
+        radius=HEAT_RADIUS
+    )
+
+def create_population_heatmap(city_data, output_file='population_map.html', heat_grid='auto', heat_url=None):
+    """Create a heatmap showing city populations
+
+    heat_grid controls server-side binning of the heat points (see aggregation.heat_points).
+    With a heat_url, a dataset's pyramid under HEAT_API_URL, the heat layer is fetched from it instead.
+    """
+    import folium
+    from folium.plugins import HeatMap
+    from map_layers import DynamicHeatMap
+    
     # Calculate mean coordinates from the city data for map centering
     mean_lat = city_data['lat'].mean()
     mean_long = city_data['lng'].mean()
@@ -159,14 +480,20 @@ def create_population_heatmap(city_data):
     # Create the map centered on the mean coordinates of the cities
     m = folium.Map(location=map_center, zoom_start=10)
     
-    # Create heat data from city populations
-    heat_data = []
-    for idx, row in city_data.iterrows():
-        # Add [latitude, longitude, population] for each city
-        heat_data.append([row['lat'], row['lng'], row['population']])
-    
-    # Add heatmap to the Folium map
-    HeatMap(heat_data, radius=55, blur=15, max_zoom=13).add_to(m)
+    if heat_url:
+        # Load only the visible part of the heat layer on demand
+        DynamicHeatMap(
+            heat_url, 'population', radius=HEAT_RADIUS, blur=HEAT_BLUR, max_zoom=HEAT_MAX_ZOOM
+        ).add_to(m)
+    else:
+        # Create heat data from city populations as [latitude, longitude, population]
+        heat_data = heat_points(
+            city_data['lat'], city_data['lng'], city_data['population'],
+            radius=HEAT_RADIUS, max_zoom=HEAT_MAX_ZOOM, heat_grid=heat_grid
+        )
+        
+        # Add heatmap to the Folium map
+        HeatMap(heat_data, radius=HEAT_RADIUS, blur=HEAT_BLUR, max_zoom=HEAT_MAX_ZOOM).add_to(m)
     
     # Add a title
     title_html = '''
@@ -177,18 +504,29 @@ def create_population_heatmap(city_data):
     <h4 style="text-align:center; margin-top: 5px; color: white;">Population Distribution</h4>
     </div>
     '''
-    m.get_root().html.add_child(folium.Element(title_html))
+    # The report shows its own heading above inlined maps
+    if not is_fragment(output_file):
+        m.get_root().html.add_child(folium.Element(title_html))
     
     # Add layer control
     folium.LayerControl().add_to(m)
     
-    # Save to a temporary HTML file
-    map_file = 'population_map.html'
-    m.save(map_file)
-    return map_file
+    # Save to HTML
+    return save_map(m, output_file)
+
+def create_cancer_incidence_map(merged_data, cancer_cols, output_file='cancer_map.html', marker_mode='auto',
+                                heat_grid='auto', heat_url=None):
+    """Create a heatmap of cancer incidence rates
 
-def create_cancer_incidence_map(merged_data, cancer_cols):
-    """Create a heatmap of cancer incidence rates"""
+    marker_mode is one of MARKER_MODES: 'markers' draws every city, 'cluster'
+    groups nearby cities and 'auto' clusters above CLUSTER_THRESHOLD cities.
+    heat_grid controls server-side binning of the heat points (see aggregation.heat_points).
+    With a heat_url, a dataset's pyramid under HEAT_API_URL, the heat layer is fetched from it instead.
+    """
+    import folium
+    from folium.plugins import HeatMap
+    from map_layers import DynamicHeatMap, city_marker_layer, city_marker_rows
+    
     # Calculate mean coordinates from the data for map centering
     mean_lat = merged_data['lat'].mean()
     mean_long = merged_data['lng'].mean()
@@ -197,67 +535,42 @@ def create_cancer_incidence_map(merged_data, cancer_cols):
     # Create the map centered on the mean coordinates
     m = folium.Map(location=map_center, zoom_start=10)
     
-    # Calculate total cancer incidence for each city
-    merged_data['TotalCancer'] = merged_data[cancer_cols].sum(axis=1)
-    
-    # Calculate cases per capita (cases per 1000 people)
-    merged_data['CancerRate'] = (merged_data['TotalCancer'] / merged_data['population']) * 1000
+    # Calculate total cancer incidence and cases per capita for each city
+    total_cancer, cancer_rate = cancer_totals(merged_data, cancer_cols)
+    merged_data = merged_data.assign(TotalCancer=total_cancer, CancerRate=cancer_rate)
     heat_metric = 'CancerRate'
     popup_metric = 'Cancer Rate per 1,000'
     
-    # Prepare heat data
-    heat_data = merged_data[['lat', 'lng', heat_metric]].values.tolist()
-    
-    # Add heatmap to the map
-    HeatMap(
-        heat_data,
-        radius=55,
-        blur=15,
-        max_zoom=13
-    ).add_to(m)
-    
-    # Create markers for each city with popups
-    for idx, row in merged_data.iterrows():
-        # Create table for cancer data
-        table_html = f"""
-        <table style="width: 100%; border-collapse: collapse; color: white;">
-            <tr>
-                <th style="border: 1px solid #415a77; padding: 5px; background-color: #415a77;">Cancer Type</th>
-                <th style="border: 1px solid #415a77; padding: 5px; background-color: #415a77;">Cases</th>
-            </tr>
-        """
-        
-        for cancer in cancer_cols:
-            if row[cancer] > 0:
-                table_html += f"""
-                <tr>
-                    <td style="border: 1px solid #415a77; padding: 5px;">{cancer}</td>
-                    <td style="border: 1px solid #415a77; padding: 5px; text-align: center;">{int(row[cancer])}</td>
-                </tr>
-                """
-        
-        table_html += "</table>"
-        
-        # Create popup content
-        popup_html = f"""
-        <div style="font-family: 'Roboto', Arial, sans-serif; color: white; background-color: #1b263b; padding: 10px; border-radius: 5px; border: 1px solid #415a77; width: 300px;">
-            <h3 style="color: white; margin-top: 0;">{row['City']}, {row['State']}</h3>
-            <p><strong>{popup_metric}:</strong> {round(row[heat_metric], 1)}</p>
-            <p><strong>Population:</strong> {row['population']:,}</p>
-            <p><strong>Total Cancer Cases:</strong> {int(row['TotalCancer'])}</p>
-            <h4 style="color: white; margin-bottom: 5px;">Cancer Type Breakdown:</h4>
-            {table_html}
-        </div>
-        """
+    if heat_url:
+        # Load only the visible part of the heat layer on demand
+        DynamicHeatMap(
+            heat_url, heat_metric, radius=HEAT_RADIUS, blur=HEAT_BLUR, max_zoom=HEAT_MAX_ZOOM
+        ).add_to(m)
+    else:
+        # Prepare heat data
+        heat_data = heat_points(
+            merged_data['lat'], merged_data['lng'], merged_data[heat_metric],
+            radius=HEAT_RADIUS, max_zoom=HEAT_MAX_ZOOM, heat_grid=heat_grid
+        )
         
-        # Add marker with popup
-        popup = folium.Popup(popup_html, max_width=500)
-        folium.Marker(
-            location=[row['lat'], row['lng']],
-            popup=popup,
-            icon=folium.Icon(color='blue', icon='info-sign')
+        # Add heatmap to the map
+        HeatMap(
+            heat_data,
+            radius=HEAT_RADIUS,
+            blur=HEAT_BLUR,
+            max_zoom=HEAT_MAX_ZOOM
         ).add_to(m)
     
+    # Create one marker per city from a single data array; popups are built on click
+    if marker_mode == 'auto':
+        marker_mode = 'cluster' if len(merged_data) > CLUSTER_THRESHOLD else 'markers'
+    city_marker_layer(
+        city_marker_rows(merged_data, cancer_cols, heat_metric),
+        cancer_cols,
+        popup_metric,
+        clustered=(marker_mode == 'cluster')
+    ).add_to(m)
+    
     # Add title
     title_html = '''
     <div style="position: fixed; top: 10px; left: 50px; width: 300px; height: 30px; 
@@ -265,19 +578,20 @@ def create_cancer_incidence_map(merged_data, cancer_cols):
         <h4 style="text-align:center; margin-top: 5px; color: white;">Cancer Incidence Heatmap</h4>
     </div>
     '''
-    m.get_root().html.add_child(folium.Element(title_html))
+    # The report shows its own heading above inlined maps
+    if not is_fragment(output_file):
+        m.get_root().html.add_child(folium.Element(title_html))
     
     # Add layer control
     folium.LayerControl().add_to(m)
     
     # Save to HTML
-    map_file = 'cancer_map.html'
-    m.save(map_file)
-    
-    return map_file
+    return save_map(m, output_file)
 
-def create_race_demographics_chart(county_race_data):
+def create_race_demographics_chart(county_race_data, output_file='race_demographics.html'):
     """Create a chart showing race/ethnicity demographics by county"""
+    import plotly.graph_objs as go
+    
     race_cols = [col for col in county_race_data.columns if col != 'County']
     
     fig = go.Figure()
@@ -332,17 +646,16 @@ def create_race_demographics_chart(county_race_data):
         ]
     )
     
-    chart_file = 'race_demographics.html'
-    pio.write_html(fig, file=chart_file, full_html=True, include_plotlyjs='cdn', config={
+    return save_figure(fig, output_file, config={
         'displayModeBar': True,
         'scrollZoom': True,
         'modeBarButtonsToAdd': ['v1hovermode', 'hoverclosest', 'hovercompare']
     })
-    
-    return chart_file
 
-def create_age_distribution_chart(age_sex_data):
+def create_age_distribution_chart(age_sex_data, output_file='age_distribution.html'):
     """Create a chart showing age distribution by sex"""
+    import plotly.graph_objs as go
+    
     age_cols = [col for col in age_sex_data.columns if col != 'Sex']
     
     fig = go.Figure()
@@ -395,35 +708,48 @@ def create_age_distribution_chart(age_sex_data):
         ]
     )
     
-    chart_file = 'age_distribution.html'
-    pio.write_html(fig, file=chart_file, full_html=True, include_plotlyjs='cdn', config={
+    return save_figure(fig, output_file, config={
         'displayModeBar': True,
         'scrollZoom': True
     })
-    
-    return chart_file
 
-def create_trend_analysis(cancer_data, year_cols):
-    """Create a line chart showing cancer trends over time"""
-    year_data = cancer_data.melt(
-        id_vars=['City'], 
-        value_vars=year_cols,
-        var_name='Year',
-        value_name='Cases'
-    )
-    year_data['Year'] = year_data['Year'].astype(int)
+def create_trend_analysis(cities, years, counts, output_file='cancer_trends.html'):
+    """Create a line chart showing cancer trends over time
+
+    counts holds one row per entry of cities and one column per entry of
+    years; rows of cities sharing a name are drawn as one line. Above
+    TREND_TRACE_THRESHOLD cities, only the TREND_TOP_CITIES cities with the
+    most cases get their own line and the rest share one Scattergl trace.
+    """
+    import numpy as np
+    import plotly.graph_objs as go
     
     fig = go.Figure()
     
     from plotly.colors import qualitative
     colors = qualitative.Plotly
     
-    for i, city in enumerate(year_data['City'].unique()):
-        city_data = year_data[year_data['City'] == city]
+    # Group the rows of each city with one sort instead of a scan per city
+    names, first_rows, city_codes = np.unique(cities, return_index=True, return_inverse=True)
+    city_codes = city_codes.ravel()
+    order = np.argsort(city_codes, kind='stable')
+    city_rows = np.split(order, np.cumsum(np.bincount(city_codes, minlength=len(names)))[:-1])
+    
+    if len(names) > TREND_TRACE_THRESHOLD:
+        city_totals = np.bincount(city_codes, weights=np.nansum(counts, axis=1), minlength=len(names))
+        ranked = np.argsort(-city_totals, kind='stable')
+        lines, others = ranked[:TREND_TOP_CITIES], ranked[TREND_TOP_CITIES:]
+    else:
+        lines, others = np.argsort(first_rows, kind='stable'), []
+    
+    for i, code in enumerate(lines):
+        rows = city_rows[code]
+        city = names[code]
         
         fig.add_trace(go.Scatter(
-            x=city_data['Year'],
-            y=city_data['Cases'],
+            # Year by year, each of the city's rows in turn
+            x=np.repeat(years, len(rows)),
+            y=counts[rows].T.ravel(),
             mode='lines+markers',
             name=city,
             line=dict(color=colors[i % len(colors)], width=3),
@@ -431,6 +757,20 @@ def create_trend_analysis(cancer_data, year_cols):
             hovertemplate="<b>%{x}</b><br>Cases: %{y:,}<extra></extra>"
         ))
     
+    if len(others):
+        # One line per remaining row, separated by NaN gaps, drawn with WebGL
+        rows = np.flatnonzero(np.isin(city_codes, others))
+        gap = np.full((len(rows), 1), np.nan)
+        fig.add_trace(go.Scattergl(
+            x=np.tile(np.append(np.asarray(years, dtype=np.float64), np.nan), len(rows)),
+            y=np.hstack([counts[rows].astype(np.float64), gap]).ravel(),
+            text=np.repeat(names[city_codes[rows]].astype(str), len(years) + 1),
+            mode='lines',
+            name=f'Other cities ({len(others):,})',
+            line=dict(color='rgba(173, 181, 189, 0.35)', width=1),
+            hovertemplate="<b>%{text}</b><br>%{x}<br>Cases: %{y:,}<extra></extra>"
+        ))
+    
     fig.update_layout(
         title={
             'text': 'Cancer Cases Trend by City',
@@ -464,27 +804,22 @@ def create_trend_analysis(cancer_data, year_cols):
         ]
     )
     
-    chart_file = 'cancer_trends.html'
-    pio.write_html(fig, file=chart_file, full_html=True, include_plotlyjs='cdn', config={
+    return save_figure(fig, output_file, config={
         'displayModeBar': True,
         'scrollZoom': True
     })
-    
-    return chart_file
 
-def create_cancer_distribution_chart(cancer_data, cancer_cols):
-    """Create a chart showing distribution of cancer types"""
-    cancer_totals = {}
-    for cancer in cancer_cols:
-        cancer_totals[cancer] = cancer_data[cancer].sum()
+def create_cancer_distribution_chart(cancer_types, totals, output_file='cancer_distribution.html'):
+    """Create a chart showing distribution of cancer types from their total case counts"""
+    import plotly.graph_objs as go
     
     colors = ['#ff9999','#66b3ff','#99ff99','#ffcc99','#c2c2f0','#ffb3e6', '#ffd700']
     
     fig = go.Figure(data=[go.Pie(
-        labels=list(cancer_totals.keys()),
-        values=list(cancer_totals.values()),
+        labels=list(cancer_types),
+        values=list(totals),
         hole=.3,
-        marker_colors=colors[:len(cancer_totals)],
+        marker_colors=colors[:len(cancer_types)],
         hovertemplate="<b>%{label}</b><br>Cases: %{value:,}<br>Percentage: %{percent}<extra></extra>"
     )])
     
@@ -515,16 +850,28 @@ def create_cancer_distribution_chart(cancer_data, cancer_cols):
         ]
     )
     
-    chart_file = 'cancer_distribution.html'
-    pio.write_html(fig, file=chart_file, full_html=True, include_plotlyjs='cdn', config={
+    return save_figure(fig, output_file, config={
         'displayModeBar': True,
         'scrollZoom': True
     })
-    
-    return chart_file
 
-def generate_html_output(population_map, cancer_map, extra_charts, created_visualizations):
-    """Combine all visualizations into a single HTML file"""
+def generate_html_output(population_map, cancer_map, extra_charts, created_visualizations, output_folder=".",
+                         report_mode='iframes'):
+    """Combine all visualizations into a single HTML file next to them
+
+    In 'single' report_mode the artifacts are fragments that are inlined into
+    the report; in 'iframes' mode they are standalone pages embedded by URL.
+    """
+    inlined = []
+    
+    def embed(artifact):
+        if report_mode == 'iframes':
+            return f'<iframe src="{os.path.basename(artifact)}"></iframe>'
+        fragment = load_fragment(artifact)
+        element_id = os.path.splitext(os.path.basename(artifact))[0]
+        inlined.append((fragment, element_id))
+        return fragment_body(fragment, element_id)
+    
     # Start building the HTML template
     html_template = """
     <!DOCTYPE html>
@@ -533,6 +880,7 @@ def generate_html_output(population_map, cancer_map, extra_charts, created_visua
         <meta charset="UTF-8">
         <meta name="viewport" content="width=device-width, initial-scale=1.0">
         <title>Cancer Data Visualization Report</title>
+        <!-- fragment headers -->
         <style>
             body {
                 font-family: 'Roboto', Arial, sans-serif;
@@ -602,6 +950,11 @@ def generate_html_output(population_map, cancer_map, extra_charts, created_visua
                 width: 100%;
                 height: 100%;
             }
+            .plotly-chart {
+                width: 100%;
+                height: 100%;
+                overflow-y: auto;
+            }
             .two-column {
                 display: flex;
                 gap: 20px;
@@ -656,7 +1009,7 @@ def generate_html_output(population_map, cancer_map, extra_charts, created_visua
                     <div class="section">
                         <h2>Population Distribution</h2>
                         <div class="map-container">
-                            <iframe src="/{population_map}"></iframe>
+                            {embed(population_map)}
                         </div>
                     </div>
                 </div>
@@ -669,7 +1022,7 @@ def generate_html_output(population_map, cancer_map, extra_charts, created_visua
                     <div class="section">
                         <h2>Cancer Incidence Heatmap</h2>
                         <div class="map-container">
-                            <iframe src="/{cancer_map}"></iframe>
+                            {embed(cancer_map)}
                         </div>
                     </div>
                 </div>
@@ -679,17 +1032,18 @@ def generate_html_output(population_map, cancer_map, extra_charts, created_visua
         
         # Now handle the additional chart files
         chart_mapping = {
-            'race_demographics.html': ('Race/Ethnicity Demographics', 'race_demographics'),
-            'age_distribution.html': ('Age Distribution', 'age_distribution'),
-            'cancer_trends.html': ('Cancer Trends Over Time', 'cancer_trends'),
-            'cancer_distribution.html': ('Cancer Type Distribution', 'cancer_distribution')
+            'race_demographics': 'Race/Ethnicity Demographics',
+            'age_distribution': 'Age Distribution',
+            'cancer_trends': 'Cancer Trends Over Time',
+            'cancer_distribution': 'Cancer Type Distribution'
         }
+        chart_files = {os.path.splitext(os.path.basename(c))[0]: c for c in extra_charts}
         
         # Group charts in pairs for the two-column layout
         charts_to_display = []
-        for chart_file, (title, key) in chart_mapping.items():
-            if created_visualizations.get(key, False) and chart_file in [os.path.basename(c) for c in extra_charts]:
-                charts_to_display.append((chart_file, title))
+        for key, title in chart_mapping.items():
+            if created_visualizations.get(key, False) and key in chart_files:
+                charts_to_display.append((chart_files[key], title))
         
         # Process charts in pairs for the two-column layout
         for i in range(0, len(charts_to_display), 2):
@@ -702,7 +1056,7 @@ def generate_html_output(population_map, cancer_map, extra_charts, created_visua
                 <div class="section">
                     <h2>{first_title}</h2>
                     <div class="chart-container">
-                        <iframe src="/{first_chart}"></iframe>
+                        {embed(first_chart)}
                     </div>
                 </div>
             </div>
@@ -716,7 +1070,7 @@ def generate_html_output(population_map, cancer_map, extra_charts, created_visua
                     <div class="section">
                         <h2>{second_title}</h2>
                         <div class="chart-container">
-                            <iframe src="/{second_chart}"></iframe>
+                            {embed(second_chart)}
                         </div>
                     </div>
                 </div>
@@ -724,17 +1078,25 @@ def generate_html_output(population_map, cancer_map, extra_charts, created_visua
             
             html_template += '</div>'
     
-    # Close the HTML
+    # Libraries shared by the inlined artifacts are loaded once, in the head
+    fragments = [fragment for fragment, _ in inlined]
+    html_template = html_template.replace('<!-- fragment headers -->', '\n'.join(fragment_headers(fragments)))
+    
+    # Close the HTML, drawing each inlined artifact in its own script
     html_template += """
         </div>
+    """
+    for fragment, element_id in inlined:
+        html_template += f"<script>{fragment_script(fragment, element_id)}</script>\n"
+    html_template += """
     </body>
     </html>
     """
     
     # Write the final HTML
-    output_file = "custom_cancer_map_v12_4.html"
-    with open(output_file, "w") as f:
-        f.write(html_template)
+    output_file = os.path.join(output_folder, REPORT_FILE)
+    atomic_write(output_file, html_template)
+    artifacts.publish(output_file)
     
     print(f"{output_file} has been created with successfully generated visualizations.")
     return output_file
@@ -0,0 +1,262 @@
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from cancer_tensor import LONG_COLUMNS, CancerTensor, is_long_format
+
+# Validated uploads are stored next to their CSV as typed NumPy columns, with
+# their JSON schema in the same file, so rendering never parses the CSV text again
+ARRAYS_SUFFIX = '.npz'
+SCHEMA_KEY = 'schema'
+
+# Bump whenever the layout of the arrays or the schema changes
+INGEST_VERSION = 3
+
+# Uploads are converted this many rows at a time; converted chunks are
+# spilled to disk, so memory use does not grow with file size
+CHUNK_ROWS = 50000
+
+def _stat_signature(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+def ingested_path(csv_path):
+    return os.path.splitext(csv_path)[0] + ARRAYS_SUFFIX
+
+def split_columns(columns):
+    """Split cancer data columns after City and State into cancer types and years"""
+    cancer_cols = [col for col in columns[2:] if not str(col).isdigit()]
+    year_cols = [col for col in columns[2:] if str(col).isdigit()]
+    return cancer_cols, year_cols
+
+class Dictionary:
+    """Dictionary-encode values arriving in chunks, numbering them in order of first appearance
+
+    Encoding every chunk of a column gives the same codes as one pd.factorize
+    over the whole column; missing values get the code -1.
+    """
+
+    def __init__(self):
+        self.codes = {}
+
+    def encode(self, values):
+        import pandas as pd
+        codes, uniques = pd.factorize(values)
+        mapping = np.fromiter(
+            (self.codes.setdefault(value, len(self.codes)) for value in uniques), dtype=np.int32, count=len(uniques)
+        )
+        # Code -1 picks the appended -1, so missing values stay missing
+        return np.append(mapping, np.int32(-1))[codes]
+
+    def values(self):
+        return list(self.codes)
+
+class Spill:
+    """One column written to a file chunk by chunk, read back one chunk at a time"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.parts = []
+
+    def append(self, values):
+        values = np.ascontiguousarray(values)
+        self.file.write(values.tobytes())
+        self.parts.append((values.dtype, len(values)))
+
+    def close(self):
+        self.file.close()
+
+    def __len__(self):
+        return sum(rows for _, rows in self.parts)
+
+    def dtype(self):
+        return np.result_type(*[dtype for dtype, _ in self.parts]) if self.parts else np.dtype(np.float64)
+
+    def chunks(self):
+        offset = 0
+        for dtype, rows in self.parts:
+            yield np.fromfile(self.path, dtype=dtype, count=rows, offset=offset)
+            offset += dtype.itemsize * rows
+
+def _read_chunks(csv_path, chunk_rows, **kwargs):
+    import pandas as pd
+    return pd.read_csv(csv_path, chunksize=chunk_rows, **kwargs)
+
+def _save_npz(path, entries):
+    """Write an uncompressed npz, as np.savez does, one chunk at a time
+
+    entries maps each array name to (dtype, shape, chunks), the chunks
+    together holding the array's values in order.
+    """
+    import zipfile
+    with zipfile.ZipFile(path, 'w', allowZip64=True) as npz:
+        for name, (dtype, shape, chunks) in entries.items():
+            with npz.open(f'{name}.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array_header_1_0(f, {
+                    'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': shape
+                })
+                for chunk in chunks:
+                    f.write(np.ascontiguousarray(chunk, dtype=dtype).tobytes())
+
+def _array_entry(array):
+    array = np.asarray(array)
+    return array.dtype, array.shape, [array]
+
+def _spill_entry(spill, transform=None):
+    chunks = spill.chunks()
+    return spill.dtype(), (len(spill),), (map(transform, chunks) if transform else chunks)
+
+def convert_upload(csv_path, file_type, dest_csv_path=None, chunk_rows=CHUNK_ROWS):
+    """Parse a validated CSV chunk by chunk and store it as typed arrays plus a schema
+
+    dest_csv_path is where the CSV will live once it is moved into place; the
+    schema records the CSV's size and mtime, which a rename keeps, so a stale
+    conversion is never mistaken for the current upload. The arrays and the
+    schema are staged together and published as one file.
+    """
+    import pandas as pd
+    columns = list(pd.read_csv(csv_path, nrows=0).columns)
+    target = ingested_path(dest_csv_path or csv_path)
+    staging = tempfile.mkdtemp(prefix='.ingest-', dir=os.path.dirname(os.path.abspath(target)))
+    try:
+        if file_type == 'cancer' and is_long_format(columns):
+            entries, schema = _convert_long(csv_path, chunk_rows, staging)
+        else:
+            entries, schema = _convert_wide(csv_path, columns, chunk_rows, staging)
+            if file_type == 'cancer':
+                schema['cancer_cols'], schema['year_cols'] = split_columns(columns)
+        schema.update(version=INGEST_VERSION, file_type=file_type, source=_stat_signature(csv_path))
+        entries[SCHEMA_KEY] = _array_entry(json.dumps(schema))
+
+        staged = os.path.join(staging, os.path.basename(target))
+        _save_npz(staged, entries)
+        os.replace(staged, target)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return schema
+
+def _convert_wide(csv_path, columns, chunk_rows, staging):
+    """Convert one column per array; strings are dictionary-encoded as <key>_codes + <key>_values"""
+    spills = [Spill(os.path.join(staging, f'c{i}')) for i in range(len(columns))]
+    dictionaries = [Dictionary() for _ in columns]
+    kinds = [set() for _ in columns]
+    rows = 0
+    for chunk in _read_chunks(csv_path, chunk_rows):
+        rows += len(chunk)
+        for i, spill in enumerate(spills):
+            values = chunk.iloc[:, i]
+            kinds[i].add(values.dtype.kind)
+            spill.append(dictionaries[i].encode(values) if values.dtype == object else values.to_numpy())
+
+    entries = {}
+    schema_columns = []
+    for i, name in enumerate(columns):
+        key = f'c{i}'
+        spill = spills[i]
+        spill.close()
+        text = 'O' in kinds[i]
+        if len(kinds[i]) > 1 and (text or 'b' in kinds[i]):
+            # Chunks of this column parsed as different kinds of values, so
+            # it is read again as text, as pandas does for the whole file
+            spill = Spill(os.path.join(staging, f'{key}_text'))
+            dictionaries[i] = Dictionary()
+            for chunk in _read_chunks(csv_path, chunk_rows, usecols=[i], dtype=str):
+                spill.append(dictionaries[i].encode(chunk.iloc[:, 0]))
+            spill.close()
+            text = True
+        if text:
+            entries[f'{key}_codes'] = _spill_entry(spill)
+            entries[f'{key}_values'] = _array_entry(np.asarray([str(v) for v in dictionaries[i].values()], dtype=str))
+            schema_columns.append({'name': str(name), 'key': key, 'dtype': 'object', 'encoding': 'dictionary'})
+        else:
+            entries[key] = _spill_entry(spill)
+            schema_columns.append({'name': str(name), 'key': key, 'dtype': str(spill.dtype())})
+    return entries, {'format': 'wide', 'rows': rows, 'columns': schema_columns}
+
+def _convert_long(csv_path, chunk_rows, staging):
+    """Convert long-format records into the arrays of a city x cancer type x year CancerTensor"""
+    import pandas as pd
+    city_keys, cancer_types, years = Dictionary(), Dictionary(), Dictionary()
+    spills = {name: Spill(os.path.join(staging, name)) for name in ('city', 'cancer_type', 'year', 'counts')}
+    for chunk in _read_chunks(csv_path, chunk_rows):
+        chunk = chunk.set_axis(LONG_COLUMNS, axis=1)
+        pairs = pd.MultiIndex.from_arrays([chunk['City'].astype(str), chunk['State'].astype(str)])
+        spills['city'].append(city_keys.encode(pairs))
+        spills['cancer_type'].append(cancer_types.encode(chunk['CancerType'].astype(str)))
+        spills['year'].append(years.encode(chunk['Year'].to_numpy(dtype=np.int64)))
+        spills['counts'].append(chunk['Count'].to_numpy())
+    for spill in spills.values():
+        spill.close()
+
+    # The year axis is sorted, so year codes are renumbered by rank
+    year_values = np.asarray(years.values(), dtype=np.int64)
+    order = np.argsort(year_values)
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    pairs = city_keys.values()
+    axes = {
+        'cities': np.asarray([city for city, _ in pairs], dtype=str),
+        'states': np.asarray([state for _, state in pairs], dtype=str),
+        'cancer_types': np.asarray(cancer_types.values(), dtype=str),
+        'years': year_values[order]
+    }
+
+    entries = {name: _array_entry(array) for name, array in axes.items()}
+    entries['coord_city'] = _spill_entry(spills['city'])
+    entries['coord_cancer_type'] = _spill_entry(spills['cancer_type'])
+    entries['coord_year'] = _spill_entry(spills['year'], lambda codes: rank[codes])
+    entries['counts'] = _spill_entry(spills['counts'])
+    schema = {
+        'format': 'long',
+        'rows': len(spills['counts']),
+        'shape': [len(axes['cities']), len(axes['cancer_types']), len(axes['years'])],
+        'cancer_cols': axes['cancer_types'].tolist(),
+        'year_cols': [str(year) for year in axes['years'].tolist()]
+    }
+    return entries, schema
+
+def load_schema(csv_path):
+    """Return the schema of an upload's conversion, or None if it is missing or stale"""
+    try:
+        with np.load(ingested_path(csv_path), allow_pickle=False) as npz:
+            schema = json.loads(npz[SCHEMA_KEY].item())
+    except (FileNotFoundError, KeyError, ValueError):
+        return None
+    if schema.get('version') != INGEST_VERSION or schema.get('source') != _stat_signature(csv_path):
+        return None
+    return schema
+
+def converted_schema(csv_path, file_type):
+    """Return the schema of an upload's conversion, converting the upload first if needed"""
+    return load_schema(csv_path) or convert_upload(csv_path, file_type)
+
+def load_upload(csv_path, file_type):
+    """Return an upload as a DataFrame together with its schema
+
+    Uploads that were never converted, such as files copied into the uploads
+    folder by hand, are converted on first use. Long-format cancer data is
+    returned in the wide layout (see CancerTensor.to_wide).
+    """
+    import pandas as pd
+    schema = converted_schema(csv_path, file_type)
+    if schema['format'] == 'long':
+        return load_tensor(csv_path).to_wide(), schema
+
+    data = {}
+    with np.load(ingested_path(csv_path), allow_pickle=False) as npz:
+        for column in schema['columns']:
+            key = column['key']
+            if column.get('encoding') == 'dictionary':
+                # Code -1 picks the appended NaN, so missing cells stay missing
+                values = np.append(npz[f'{key}_values'].astype(object), np.nan)[npz[f'{key}_codes']]
+            else:
+                values = npz[key]
+            data[column['name']] = values
+    return pd.DataFrame(data, columns=[column['name'] for column in schema['columns']]), schema
+
+def load_tensor(csv_path):
+    """Return the CancerTensor of a converted long-format cancer upload"""
+    with np.load(ingested_path(csv_path), allow_pickle=False) as npz:
+        return CancerTensor.from_arrays({name: npz[name] for name in npz.files if name != SCHEMA_KEY})
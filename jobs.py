@@ -0,0 +1,157 @@
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Job records are JSON files so that every gunicorn worker can report on any job
+JOBS_FOLDER = 'jobs'
+
+# Finished job records older than this are pruned when new jobs are created
+JOB_RETENTION_SECONDS = 24 * 60 * 60
+
+# The worker that owns a queued or running job touches its record this often;
+# a record left untouched for JOB_STALE_SECONDS belongs to a worker that died
+JOB_HEARTBEAT_SECONDS = 5
+JOB_STALE_SECONDS = 60
+
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+_executor = None
+
+# Records of the jobs queued or running in this process, kept alive by the heartbeat thread
+_active = {}
+_active_lock = threading.Lock()
+_heartbeat = None
+
+def _job_path(job_id, jobs_folder):
+    return os.path.join(jobs_folder, f"{job_id}.json")
+
+def _write_job(job, jobs_folder):
+    """Atomically replace a job record so readers never see a partial file"""
+    path = _job_path(job['id'], jobs_folder)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(job, f)
+    os.replace(temp_path, path)
+
+def _beat():
+    while True:
+        time.sleep(JOB_HEARTBEAT_SECONDS)
+        with _active_lock:
+            paths = list(_active.values())
+        for path in paths:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+
+def _start_heartbeat():
+    global _heartbeat
+    with _active_lock:
+        if _heartbeat is None:
+            _heartbeat = threading.Thread(target=_beat, name='job-heartbeat', daemon=True)
+            _heartbeat.start()
+
+def get_executor(max_workers=None):
+    """Return the process-wide pool that runs background jobs"""
+    global _executor
+    if _executor is None:
+        if max_workers is None:
+            max_workers = int(os.environ.get('ONCOCONTOUR_JOB_WORKERS', '1'))
+        _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+    return _executor
+
+def prune_jobs(jobs_folder=JOBS_FOLDER, max_age=JOB_RETENTION_SECONDS):
+    """Delete job records that have not been updated within max_age seconds"""
+    cutoff = time.time() - max_age
+    for filename in os.listdir(jobs_folder):
+        file_path = os.path.join(jobs_folder, filename)
+        try:
+            if os.path.getmtime(file_path) < cutoff:
+                os.unlink(file_path)
+        except OSError as e:
+            print(f"Error pruning job record {file_path}: {e}")
+
+def create_job(stages, jobs_folder=JOBS_FOLDER):
+    """Create a queued job whose stages are all pending and return its record"""
+    os.makedirs(jobs_folder, exist_ok=True)
+    prune_jobs(jobs_folder)
+
+    now = time.time()
+    job = {
+        'id': uuid.uuid4().hex,
+        'status': 'queued',
+        'stages': {stage: 'pending' for stage in stages},
+        'message': None,
+        'redirect': None,
+        'created': now,
+        'updated': now
+    }
+    _write_job(job, jobs_folder)
+    return job
+
+def _finish_stages(job):
+    """Mark the stages a job never reached as skipped and the one it was in as failed"""
+    leftover = {'pending': 'skipped', 'running': 'failed'}
+    return {stage: leftover[status] for stage, status in job['stages'].items() if status in leftover}
+
+def get_job(job_id, jobs_folder=JOBS_FOLDER):
+    """Return the record of a job, or None if it does not exist
+
+    A queued or running job whose record has missed its heartbeats lost its
+    worker, for instance to a gunicorn restart, and is reported as failed.
+    """
+    if not JOB_ID_PATTERN.match(job_id):
+        return None
+    try:
+        with open(_job_path(job_id, jobs_folder)) as f:
+            job = json.load(f)
+            touched = os.fstat(f.fileno()).st_mtime
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if job['status'] in ('queued', 'running') and time.time() - touched > JOB_STALE_SECONDS:
+        job['stages'].update(_finish_stages(job))
+        job.update(status='failed', message='Job stopped responding; its worker may have restarted. Please try again.')
+    return job
+
+def update_job(job_id, jobs_folder=JOBS_FOLDER, stages=None, **fields):
+    """Update fields and stage statuses of a job record"""
+    job = get_job(job_id, jobs_folder)
+    if job is None:
+        return None
+    job.update(fields)
+    if stages:
+        job['stages'].update(stages)
+    job['updated'] = time.time()
+    _write_job(job, jobs_folder)
+    return job
+
+def submit_job(job_id, func, *args, jobs_folder=JOBS_FOLDER, **kwargs):
+    """Run func in the background, reporting stage progress into the job record
+
+    func is called with a progress(stage, status) keyword argument and must
+    return a dict of final fields (status, message, redirect, ...).
+    """
+    def progress(stage, status):
+        update_job(job_id, jobs_folder, stages={stage: status})
+
+    def run():
+        try:
+            update_job(job_id, jobs_folder, status='running')
+            try:
+                result = func(*args, progress=progress, **kwargs)
+            except Exception as e:
+                result = {'status': 'failed', 'message': f'Job failed: {str(e)}'}
+            # Stages the run never reached will not happen any more
+            update_job(job_id, jobs_folder, stages=_finish_stages(get_job(job_id, jobs_folder)), **result)
+        finally:
+            with _active_lock:
+                _active.pop(job_id, None)
+
+    _start_heartbeat()
+    with _active_lock:
+        _active[job_id] = _job_path(job_id, jobs_folder)
+    return get_executor().submit(run)
@@ -0,0 +1,164 @@
+import numpy as np
+from branca.element import MacroElement
+from folium.plugins import FastMarkerCluster, HeatMap
+from jinja2 import Template
+from jinja2.utils import htmlsafe_json_dumps
+
+# Builds a city's popup in the browser from its data row, which is laid out as
+# [lat, lng, city, state, rate, population, total, count per cancer type...]
+POPUP_JS = """
+    function escapeHtml(value) {
+        return String(value).replace(/[&<>"']/g, function (c) {
+            return {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'}[c];
+        });
+    }
+
+    function cityPopupHtml(row, cancerTypes, metricLabel) {
+        var cell = 'border: 1px solid #415a77; padding: 5px;';
+        var rows = '';
+        for (var i = 0; i < cancerTypes.length; i++) {
+            var count = row[7 + i];
+            if (count > 0) {
+                rows += '<tr><td style="' + cell + '">' + escapeHtml(cancerTypes[i]) + '</td>'
+                    + '<td style="' + cell + ' text-align: center;">' + count + '</td></tr>';
+            }
+        }
+        return '<div style="font-family: \\'Roboto\\', Arial, sans-serif; color: white; background-color: #1b263b; padding: 10px; border-radius: 5px; border: 1px solid #415a77; width: 300px;">'
+            + '<h3 style="color: white; margin-top: 0;">' + escapeHtml(row[2]) + ', ' + escapeHtml(row[3]) + '</h3>'
+            + '<p><strong>' + metricLabel + ':</strong> ' + row[4].toFixed(1) + '</p>'
+            + '<p><strong>Population:</strong> ' + row[5].toLocaleString('en-US') + '</p>'
+            + '<p><strong>Total Cancer Cases:</strong> ' + row[6] + '</p>'
+            + '<h4 style="color: white; margin-bottom: 5px;">Cancer Type Breakdown:</h4>'
+            + '<table style="width: 100%; border-collapse: collapse; color: white;">'
+            + '<tr><th style="' + cell + ' background-color: #415a77;">Cancer Type</th>'
+            + '<th style="' + cell + ' background-color: #415a77;">Cases</th></tr>'
+            + rows + '</table></div>';
+    }
+"""
+
+def city_marker_rows(merged_data, cancer_cols, metric):
+    """Pack the per-city popup fields into compact JSON-ready rows, column by column"""
+    counts = np.nan_to_num(merged_data[cancer_cols].to_numpy(dtype=np.float64)).astype(np.int64)
+    columns = [
+        merged_data['lat'].to_numpy(dtype=np.float64).tolist(),
+        merged_data['lng'].to_numpy(dtype=np.float64).tolist(),
+        merged_data['City'].astype(str).tolist(),
+        merged_data['State'].astype(str).tolist(),
+        np.round(merged_data[metric].to_numpy(dtype=np.float64), 1).tolist(),
+        merged_data['population'].to_numpy(dtype=np.int64).tolist(),
+        merged_data['TotalCancer'].to_numpy(dtype=np.float64).astype(np.int64).tolist()
+    ]
+    return [list(row) for row in zip(*columns, *counts.T.tolist())]
+
+def city_marker_callback(cancer_types, metric_label):
+    """Return a JS function that turns a city row into a marker with a lazy popup"""
+    return """(function () {
+        %s
+        var cancerTypes = %s;
+        var metricLabel = %s;
+        var icon = L.AwesomeMarkers.icon({
+            "extraClasses": "fa-rotate-0", "icon": "info",
+            "iconColor": "white", "markerColor": "blue", "prefix": "fa"
+        });
+        return function (row) {
+            var marker = L.marker([row[0], row[1]], {icon: icon});
+            marker.bindPopup(function () {
+                return cityPopupHtml(row, cancerTypes, metricLabel);
+            }, {maxWidth: 500});
+            return marker;
+        };
+    })()""" % (POPUP_JS, htmlsafe_json_dumps(list(cancer_types)), htmlsafe_json_dumps(metric_label))
+
+class CityMarkers(MacroElement):
+    """One marker per city, emitted as a single data array
+
+    Popups are built in the browser when a marker is opened, so the page
+    grows with the number of cities rather than with the popup template.
+    """
+
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function(){
+                var makeMarker = {{ this.callback }};
+                var data = {{ this.data|tojson }};
+                var layer = L.featureGroup();
+
+                data.forEach(function (row) {
+                    layer.addLayer(makeMarker(row));
+                });
+
+                layer.addTo({{ this._parent.get_name() }});
+                return layer;
+            })();
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, data, cancer_types, metric_label):
+        super().__init__()
+        self._name = 'CityMarkers'
+        self.data = data
+        self.callback = city_marker_callback(cancer_types, metric_label)
+
+def city_marker_layer(data, cancer_types, metric_label, clustered=False):
+    """Return the marker layer for the incidence map, clustered for large city sets
+
+    Clustered markers keep their lazy popups, so a city's cancer breakdown is
+    still one click away once its cluster is expanded.
+    """
+    if clustered:
+        return FastMarkerCluster(
+            data,
+            callback=city_marker_callback(cancer_types, metric_label),
+            name='Cities',
+            control=False
+        )
+    return CityMarkers(data, cancer_types, metric_label)
+
+class DynamicHeatMap(HeatMap):
+    """Heat layer that fetches only the visible cells of a precomputed pyramid
+
+    The map requests url?bbox=south,west,north,east&zoom=z&metric=... after
+    every pan or zoom and replaces the layer's points with the response.
+    """
+
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = L.heatLayer([], {{ this.options|tojson }});
+            (function () {
+                var map = {{ this._parent.get_name() }};
+                var layer = {{ this.get_name() }};
+                var latest = 0;
+
+                function refresh() {
+                    var bounds = map.getBounds().pad(0.25);
+                    var params = new URLSearchParams({
+                        bbox: [bounds.getSouth(), bounds.getWest(), bounds.getNorth(), bounds.getEast()].join(','),
+                        zoom: map.getZoom(),
+                        metric: {{ this.metric|tojson }}
+                    });
+                    var request = ++latest;
+                    fetch({{ this.url|tojson }} + '?' + params, {credentials: 'same-origin'})
+                        .then(function (response) { return response.json(); })
+                        .then(function (data) {
+                            // Ignore responses that a later pan or zoom has superseded
+                            if (request === latest && data.success) {
+                                layer.setLatLngs(data.points);
+                            }
+                        });
+                }
+
+                map.on('moveend', refresh);
+                map.whenReady(refresh);
+            })();
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, url, metric, **kwargs):
+        super().__init__([], **kwargs)
+        self._name = 'DynamicHeatMap'
+        self.url = url
+        self.metric = metric
@@ -0,0 +1,230 @@
+import re
+import unicodedata
+import numpy as np
+
+# Bump whenever a rule change can match a row to a different census place
+MATCHER_VERSION = 1
+
+# How each uploaded row was matched, from most to least certain
+MATCH_METHODS = ('exact', 'normalized', 'fuzzy', 'unmatched')
+
+# Smallest trigram similarity (Dice coefficient) accepted for a fuzzy match
+FUZZY_THRESHOLD = 0.8
+
+# Fuzzy matches are scored as dense blocks of names x places of one state,
+# each holding at most this many cells
+FUZZY_BLOCK_CELLS = 1 << 22
+
+# Abbreviations expanded wherever they appear as a word
+ABBREVIATIONS = {
+    'st': 'saint', 'ste': 'sainte', 'ft': 'fort', 'mt': 'mount', 'pt': 'point',
+    'hts': 'heights', 'spgs': 'springs', 'twp': 'township', 'jct': 'junction'
+}
+
+# Compass abbreviations, expanded only as the first word ("N Las Vegas")
+DIRECTIONS = {'n': 'north', 's': 'south', 'e': 'east', 'w': 'west'}
+
+# Municipal designations some sources append to place names ("Boston city")
+PLACE_SUFFIXES = ('city', 'town', 'township', 'village', 'borough', 'cdp')
+
+APOSTROPHES = re.compile(r"['’`]")
+NON_ALPHANUMERIC = re.compile(r'[^a-z0-9]+')
+
+def normalize_city(name):
+    """Reduce a place name to a canonical form: ASCII, lower case, no punctuation, abbreviations expanded"""
+    name = unicodedata.normalize('NFKD', str(name)).encode('ascii', 'ignore').decode('ascii').lower()
+    name = APOSTROPHES.sub('', name.replace('&', ' and '))
+    words = NON_ALPHANUMERIC.sub(' ', name).split()
+    if words and words[0] in DIRECTIONS and len(words) > 1:
+        words[0] = DIRECTIONS[words[0]]
+    return ' '.join(ABBREVIATIONS.get(word, word) for word in words)
+
+def strip_place_suffix(name):
+    """Drop a trailing municipal designation from a normalized name, if it leaves a name behind"""
+    head, _, last = name.rpartition(' ')
+    return head if head and last in PLACE_SUFFIXES else name
+
+def normalize_state(state):
+    return str(state).strip().upper()
+
+def trigrams(name):
+    """Return the set of character trigrams of a normalized name, padded to weigh its start"""
+    padded = f'  {name} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def index_arrays(cities, states):
+    """Precompute the arrays of a CityMatcher over census cities and states
+
+    names holds each row's normalized name. The trigram index is stored in
+    CSR form: the census rows having the trigram gram_keys[i], a "<state>:<gram>"
+    key, are gram_rows[gram_offsets[i]:gram_offsets[i + 1]], in row order.
+    """
+    import pandas as pd
+    names = [normalize_city(city) for city in cities]
+    keys = []
+    key_rows = []
+    gram_counts = np.zeros(len(names), dtype=np.int32)
+    for row, (name, state) in enumerate(zip(names, states)):
+        grams = trigrams(name)
+        gram_counts[row] = len(grams)
+        state = normalize_state(state)
+        keys.extend(f'{state}:{gram}' for gram in grams)
+        key_rows.extend([row] * len(grams))
+
+    codes, gram_keys = pd.factorize(pd.Series(keys, dtype=object))
+    order = np.argsort(codes, kind='stable')
+    return {
+        'names': np.asarray(names, dtype=str),
+        'gram_keys': np.asarray(gram_keys, dtype=str),
+        'gram_offsets': np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(gram_keys)))]),
+        'gram_rows': np.asarray(key_rows, dtype=np.int32)[order],
+        'gram_counts': gram_counts
+    }
+
+class CityMatcher:
+    """Match (city, state) pairs to census rows through progressively looser indexes
+
+    Pairs are looked up first as written, ignoring case and spacing; then by
+    their normalized name, with or without a municipal suffix; and finally by
+    trigram similarity against the places of the same state. Where several
+    places share a key, the first row wins, which in the population-sorted
+    census is the largest place. arrays, from index_arrays, may be passed in
+    precomputed. The looser indexes are only built once a pair misses the
+    exact one, so clean uploads never pay for them.
+    """
+
+    def __init__(self, cities, states, arrays=None):
+        self.cities = cities
+        self.states = [normalize_state(state) for state in states]
+        self.arrays = arrays
+        self.exact = {}
+        for row, (city, state) in enumerate(zip(cities, self.states)):
+            self.exact.setdefault((' '.join(str(city).split()).lower(), state), row)
+        self.normalized = None
+
+    def _build_loose_indexes(self):
+        arrays = self.arrays if self.arrays is not None else index_arrays(self.cities, self.states)
+        names = arrays['names'].tolist()
+        normalized = {}
+        for row, (name, state) in enumerate(zip(names, self.states)):
+            normalized.setdefault((name, state), row)
+        # Suffixless names only fill gaps, so a real "Carson City" keeps its full name
+        for row, (name, state) in enumerate(zip(names, self.states)):
+            normalized.setdefault((strip_place_suffix(name), state), row)
+
+        import pandas as pd
+        self.gram_lookup = pd.Index(arrays['gram_keys'], dtype=object)
+        self.gram_offsets = np.asarray(arrays['gram_offsets'], dtype=np.int64)
+        self.gram_rows = np.asarray(arrays['gram_rows'])
+        self.gram_counts = np.asarray(arrays['gram_counts'])
+
+        # The census rows of each state, in row order, and each row's position among them
+        self.state_rows = {}
+        for row, state in enumerate(self.states):
+            self.state_rows.setdefault(state, []).append(row)
+        self.state_rows = {state: np.asarray(rows) for state, rows in self.state_rows.items()}
+        self.state_position = np.empty(len(self.states), dtype=np.int64)
+        for rows in self.state_rows.values():
+            self.state_position[rows] = np.arange(len(rows))
+        self.normalized = normalized
+
+    def fuzzy_many(self, names, states):
+        """Return the most similar census row of each name's state and its similarity
+
+        Rows are -1 where no place reaches FUZZY_THRESHOLD. The names of a
+        state are scored together: the trigrams they share with every place
+        are counted with one np.bincount over all candidate pairs.
+        """
+        rows = np.full(len(names), -1, dtype=np.int64)
+        scores = np.zeros(len(names), dtype=np.float64)
+        queries = {}
+        for i, state in enumerate(states):
+            queries.setdefault(state, []).append(i)
+        for state, indexes in queries.items():
+            places = self.state_rows.get(state)
+            if places is None:
+                continue
+            step = max(1, FUZZY_BLOCK_CELLS // len(places))
+            for start in range(0, len(indexes), step):
+                block = np.asarray(indexes[start:start + step])
+                rows[block], scores[block] = self._fuzzy_block([names[i] for i in block], state, places)
+        return rows, scores
+
+    def _fuzzy_block(self, names, state, places):
+        """Score names against the places of their state, returning rows and similarities like fuzzy_many"""
+        rows = np.full(len(names), -1, dtype=np.int64)
+        scores = np.zeros(len(names), dtype=np.float64)
+        grams = [trigrams(name) for name in names]
+        lengths = np.fromiter(map(len, grams), dtype=np.int64, count=len(names))
+        keys = self.gram_lookup.get_indexer([f'{state}:{gram}' for name_grams in grams for gram in name_grams])
+        known = keys >= 0
+        owners = np.repeat(np.arange(len(names)), lengths)[known]
+        keys = keys[known]
+        if not len(keys):
+            return rows, scores
+
+        # Expand every key into the run of census rows having it and count the
+        # trigrams each name shares with each place of the state
+        starts = self.gram_offsets[keys]
+        sizes = self.gram_offsets[keys + 1] - starts
+        ends = np.cumsum(sizes)
+        positions = np.repeat(starts - ends + sizes, sizes) + np.arange(ends[-1])
+        cells = np.repeat(owners, sizes) * len(places) + self.state_position[self.gram_rows[positions]]
+        shared = np.bincount(cells, minlength=len(names) * len(places))
+
+        # Only pairs sharing a trigram can score; cells come in name, then place order
+        cells = np.flatnonzero(shared)
+        owners, columns = np.divmod(cells, len(places))
+        similarity = 2 * shared[cells] / (lengths[owners] + self.gram_counts[places][columns])
+        group_starts = np.flatnonzero(np.r_[True, owners[1:] != owners[:-1]])
+        best = np.maximum.reduceat(similarity, group_starts)
+        # The first place reaching a name's best score has the lowest row, so it is the largest place
+        reached = np.flatnonzero(similarity == np.repeat(best, np.diff(np.r_[group_starts, len(cells)])))
+        first = reached[np.r_[True, owners[reached][1:] != owners[reached][:-1]]]
+        scores[owners[first]] = best
+        accepted = first[best >= FUZZY_THRESHOLD]
+        rows[owners[accepted]] = places[columns[accepted]]
+        return rows, scores
+
+    def match_one(self, city, state):
+        """Return (row, method, score) for one pair; row is -1 when unmatched"""
+        rows, methods, scores = self.match([city], [state])
+        return int(rows[0]), methods[0], float(scores[0])
+
+    def match(self, cities, states):
+        """Match arrays of cities and states, returning row numbers, methods and scores
+
+        Each distinct pair is matched once, however often it repeats, and the
+        pairs left for fuzzy matching are scored in one batch.
+        """
+        import pandas as pd
+        codes, pairs = pd.MultiIndex.from_arrays([
+            pd.Series(cities, dtype=object).astype(str), pd.Series(states, dtype=object).astype(str)
+        ]).factorize()
+        rows = np.full(len(pairs), -1, dtype=np.int64)
+        methods = np.full(len(pairs), 'unmatched', dtype=object)
+        scores = np.zeros(len(pairs), dtype=np.float64)
+        misses = []
+        for i, (city, state) in enumerate(pairs):
+            state = normalize_state(state)
+            row = self.exact.get((' '.join(str(city).split()).lower(), state))
+            if row is not None:
+                rows[i], methods[i], scores[i] = row, 'exact', 1.0
+                continue
+            if self.normalized is None:
+                self._build_loose_indexes()
+            name = normalize_city(city)
+            for key in (name, strip_place_suffix(name)):
+                row = self.normalized.get((key, state))
+                if row is not None:
+                    rows[i], methods[i], scores[i] = row, 'normalized', 1.0
+                    break
+            else:
+                misses.append((i, name, state))
+
+        if misses:
+            indexes, names, miss_states = zip(*misses)
+            indexes = np.asarray(indexes)
+            rows[indexes], scores[indexes] = self.fuzzy_many(names, miss_states)
+            methods[indexes] = np.where(rows[indexes] >= 0, 'fuzzy', 'unmatched')
+        return rows[codes], methods[codes], scores[codes]
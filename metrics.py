@@ -0,0 +1,223 @@
+import atexit
+import json
+import os
+import threading
+import time
+import uuid
+from workspaces import atomic_write
+
+# Every process writes its metrics to its own JSON file in this folder, and
+# /metrics adds the files of all gunicorn workers together
+METRICS_FOLDER = os.environ.get('ONCOCONTOUR_METRICS_DIR', 'metrics')
+
+# How often each process writes its metrics out, so a scrape lags by at most this
+FLUSH_INTERVAL_SECONDS = 1.0
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(11))
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'oncocontour_request_duration_seconds': (
+        'histogram', 'Time spent handling a request, by endpoint', LATENCY_BUCKETS
+    ),
+    'oncocontour_render_span_seconds': (
+        'histogram', 'Wall time of visualization spans, by span and parent span', LATENCY_BUCKETS
+    ),
+    'oncocontour_upload_bytes': ('histogram', 'Size of accepted uploads, by file type', SIZE_BUCKETS),
+    'oncocontour_merge_rows_total': (
+        'counter', 'Uploaded cancer rows merged with the census, by how they matched a city', None
+    ),
+    'oncocontour_render_cache_total': ('counter', 'Render cache lookups, by result', None),
+    'oncocontour_artifact_cache_total': ('counter', 'In-memory artifact cache reads, by result', None),
+    'oncocontour_jobs_in_flight': ('gauge', 'Visualization jobs queued or running', None)
+}
+
+_lock = threading.Lock()
+_store = None
+_collectors = []
+
+# Set by start_flusher; until then metrics are only kept in memory
+_folder = None
+
+def _new_store():
+    return {
+        'pid': os.getpid(),
+        # Tells apart processes that reuse a pid, so their counts are never overwritten
+        'token': uuid.uuid4().hex,
+        'values': {},
+        'dirty': False,
+        'flushing': False
+    }
+
+def _current_store():
+    """Return this process's store, starting a new one after a fork, and its flusher once enabled"""
+    global _store
+    if _store is None or _store['pid'] != os.getpid():
+        _store = _new_store()
+    if _folder is not None and not _store['flushing']:
+        _store['flushing'] = True
+        threading.Thread(target=_flush_loop, args=(_store,), daemon=True, name='metrics-flush').start()
+    return _store
+
+def _label_key(labels):
+    return json.dumps(sorted(labels.items()))
+
+def _series(name, labels):
+    metric_type, _, buckets = METRICS[name]
+    series = _current_store()['values'].setdefault(name, {})
+    key = _label_key(labels)
+    if key not in series:
+        if metric_type == 'histogram':
+            series[key] = {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+        else:
+            series[key] = 0
+    return series, key
+
+def inc(name, value=1, **labels):
+    """Add value to a counter or gauge"""
+    with _lock:
+        series, key = _series(name, labels)
+        series[key] += value
+        _current_store()['dirty'] = True
+
+def dec(name, value=1, **labels):
+    inc(name, -value, **labels)
+
+def observe(name, value, **labels):
+    """Record a value in a histogram"""
+    buckets = METRICS[name][2]
+    with _lock:
+        series, key = _series(name, labels)
+        histogram = series[key]
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram['buckets'][i] += 1
+                break
+        histogram['sum'] += value
+        histogram['count'] += 1
+        _current_store()['dirty'] = True
+
+def add_collector(collect):
+    """Register a function returning (name, labels, total) counters this process keeps itself
+
+    Collectors are read on every flush, for totals such as the artifact cache's
+    hit count that are already counted elsewhere.
+    """
+    _collectors.append(collect)
+
+def flush():
+    """Write this process's metrics to its file in the metrics folder"""
+    if _folder is None:
+        return
+    collected = [sample for collect in _collectors for sample in collect()]
+    with _lock:
+        store = _current_store()
+        for name, labels, total in collected:
+            series, key = _series(name, labels)
+            if series[key] != total:
+                series[key] = total
+                store['dirty'] = True
+        if not store['dirty']:
+            return
+        data = json.dumps({'pid': store['pid'], 'values': store['values']})
+        store['dirty'] = False
+    os.makedirs(_folder, exist_ok=True)
+    atomic_write(os.path.join(_folder, f"{store['pid']}-{store['token']}.json"), data)
+
+def _flush_loop(store):
+    while store is _store:
+        time.sleep(FLUSH_INTERVAL_SECONDS)
+        try:
+            flush()
+        except OSError as e:
+            print(f"Error writing metrics: {e}")
+
+def start_flusher(folder=METRICS_FOLDER):
+    """Have this process, and any process forked from it, write its metrics to folder"""
+    global _folder
+    with _lock:
+        _folder = folder
+        _current_store()
+    atexit.register(flush)
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def aggregate(folder=None):
+    """Add up the metrics written by every process
+
+    Counters and histograms of exited workers are kept, so totals never go
+    backwards when gunicorn replaces a worker; gauges only count live ones.
+    """
+    folder = folder or _folder or METRICS_FOLDER
+    totals = {}
+    try:
+        filenames = sorted(os.listdir(folder))
+    except FileNotFoundError:
+        filenames = []
+    for filename in filenames:
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(folder, filename)) as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            continue
+        alive = _is_alive(data['pid'])
+        for name, series in data['values'].items():
+            if name not in METRICS:
+                continue
+            metric_type = METRICS[name][0]
+            if metric_type == 'gauge' and not alive:
+                continue
+            merged = totals.setdefault(name, {})
+            for key, value in series.items():
+                if metric_type != 'histogram':
+                    merged[key] = merged.get(key, 0) + value
+                elif key not in merged:
+                    merged[key] = {'buckets': list(value['buckets']), 'sum': value['sum'], 'count': value['count']}
+                else:
+                    merged[key]['buckets'] = [a + b for a, b in zip(merged[key]['buckets'], value['buckets'])]
+                    merged[key]['sum'] += value['sum']
+                    merged[key]['count'] += value['count']
+    return totals
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = [
+        (name, str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"'))
+        for name, value in labels
+    ]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render(totals):
+    """Format aggregated metrics in the Prometheus text exposition format"""
+    lines = []
+    for name, (metric_type, help_text, buckets) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for key, value in sorted(totals.get(name, {}).items()):
+            labels = [tuple(pair) for pair in json.loads(key)]
+            if metric_type != 'histogram':
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets, value['buckets']):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels + [('le', _format_value(bound))])} {cumulative}")
+            # Values above the last bucket only show in the +Inf bucket
+            lines.append(f"{name}_bucket{_format_labels(labels + [('le', '+Inf')])} {value['count']}")
+            lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(value["sum"])}')
+            lines.append(f'{name}_count{_format_labels(labels)} {value["count"]}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,73 @@
+import collections
+import os
+import sys
+import threading
+from workspaces import atomic_output, atomic_write
+
+# 'cprofile' records every call with cProfile; 'sample' snapshots the stack
+# at an interval, which costs little even on the largest datasets
+PROFILERS = ('cprofile', 'sample')
+
+# File written next to the report for each profiler: a pstats dump for
+# snakeviz or pstats, or collapsed stacks for flamegraph.pl or speedscope
+PROFILE_FILES = {
+    'cprofile': 'visualization.prof',
+    'sample': 'visualization.collapsed.txt'
+}
+
+SAMPLE_INTERVAL_SECONDS = 0.005
+
+class StackSampler:
+    """Count the call stacks of one thread, sampled from a background thread"""
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL_SECONDS):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True, name='stack-sampler')
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        """Return the samples in the collapsed-stack format, one 'frame;frame count' line per stack"""
+        return ''.join(f"{stack} {count}\n" for stack, count in self.counts.most_common())
+
+def profile_call(profiler, output_file, func, *args, **kwargs):
+    """Call func under a profiler, writing the profile to output_file, and return its result
+
+    Only the calling thread is profiled, so func must not hand its work to
+    other threads or processes.
+    """
+    if profiler == 'cprofile':
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            with atomic_output(output_file) as temp_file:
+                profile.dump_stats(temp_file)
+
+    sampler = StackSampler(threading.get_ident())
+    sampler.start()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        sampler.stop()
+        atomic_write(output_file, sampler.collapsed())
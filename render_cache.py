@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+from workspaces import atomic_output
+
+# Rendered artifacts are stored here under the hash of everything that went into them
+RENDER_CACHE_FOLDER = 'render_cache'
+
+# Total size the cache may grow to before the least recently used artifacts are evicted
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# Bump whenever a create_* function changes what it writes for the same inputs
+RENDER_VERSION = 4
+
+# Keys are SHA-256 hex digests (see cache_key)
+KEY_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+def max_cache_bytes():
+    """Return the configured size bound of the render cache"""
+    return int(os.environ.get('ONCOCONTOUR_RENDER_CACHE_BYTES', DEFAULT_MAX_BYTES))
+
+def is_valid_key(key):
+    return bool(KEY_PATTERN.match(key))
+
+def cache_key(stage, input_hashes, params=None):
+    """Hash a stage name, the hashes of its inputs and its rendering parameters"""
+    digest = hashlib.sha256()
+    digest.update(json.dumps({
+        'version': RENDER_VERSION,
+        'stage': stage,
+        'inputs': list(input_hashes),
+        'params': params or {}
+    }, sort_keys=True, default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+def entry_path(key, suffix, cache_folder=RENDER_CACHE_FOLDER):
+    return os.path.join(cache_folder, f"{key}{suffix}")
+
+def _copy_atomic(src, dest):
+    """Copy src to dest through a temporary file so readers never see a partial copy"""
+    with atomic_output(dest) as temp_path:
+        shutil.copyfile(src, temp_path)
+
+def fetch(key, dest, cache_folder=RENDER_CACHE_FOLDER):
+    """Copy a cached artifact to dest, returning False on a cache miss"""
+    path = entry_path(key, os.path.splitext(dest)[1], cache_folder)
+    try:
+        _copy_atomic(path, dest)
+        # Refresh the mtime, which is what the LRU eviction orders by
+        os.utime(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+def lookup(key, suffix, cache_folder=RENDER_CACHE_FOLDER):
+    """Return the path of a cached artifact, refreshing its LRU position, or None on a cache miss"""
+    path = entry_path(key, suffix, cache_folder)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    return path
+
+def add(key, suffix, write, cache_folder=RENDER_CACHE_FOLDER, max_bytes=None):
+    """Write an artifact straight into the cache with write(path), enforce the size bound and return its path"""
+    os.makedirs(cache_folder, exist_ok=True)
+    path = entry_path(key, suffix, cache_folder)
+    write(path)
+    evict(cache_folder, max_cache_bytes() if max_bytes is None else max_bytes)
+    return path
+
+def store(key, src, cache_folder=RENDER_CACHE_FOLDER, max_bytes=None):
+    """Add a freshly rendered artifact to the cache and enforce the size bound"""
+    os.makedirs(cache_folder, exist_ok=True)
+    _copy_atomic(src, entry_path(key, os.path.splitext(src)[1], cache_folder))
+    evict(cache_folder, max_cache_bytes() if max_bytes is None else max_bytes)
+
+def evict(cache_folder=RENDER_CACHE_FOLDER, max_bytes=DEFAULT_MAX_BYTES):
+    """Delete least recently used artifacts until the cache fits in max_bytes"""
+    entries = []
+    total = 0
+    for entry in os.scandir(cache_folder):
+        if not entry.is_file() or entry.name.endswith('.tmp'):
+            continue
+        stat = entry.stat()
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total += stat.st_size
+
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(path)
+            total -= size
+        except FileNotFoundError:
+            # Another worker evicted it first
+            total -= size
@@ -33,14 +33,15 @@ fi
 
 echo "🚀 Starting app on http://localhost:$PORT ..."
 
-# Create uploads directory if it doesn't exist
-mkdir -p uploads
+# Create the workspace and report directories if they don't exist
+mkdir -p workspaces reports
 
-# Run container with volume mount to persist uploads
+# Run container with volume mounts so sessions' uploads and reports survive a new container
 docker run -d \
   --name $CONTAINER_NAME \
   -p $PORT:5000 \
-  -v "$(pwd)/uploads:/app/uploads" \
+  -v "$(pwd)/workspaces:/app/workspaces" \
+  -v "$(pwd)/reports:/app/reports" \
   --restart unless-stopped \
   $IMAGE_NAME
 
@@ -0,0 +1,114 @@
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+# Linux keeps the peak RSS of a process in VmHWM, which writing "5" to
+# clear_refs resets, so each span can measure its own peak
+STATUS_FILE = '/proc/self/status'
+CLEAR_REFS_FILE = '/proc/self/clear_refs'
+
+# Spans are printed as one JSON object per line after this prefix
+LOG_PREFIX = 'span'
+
+_local = threading.local()
+
+def _stack(name):
+    if not hasattr(_local, name):
+        setattr(_local, name, [])
+    return getattr(_local, name)
+
+def peak_rss_bytes():
+    """Return the peak RSS of this process since the last reset_peak_rss"""
+    try:
+        with open(STATUS_FILE) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux and is never reset
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def reset_peak_rss():
+    try:
+        with open(CLEAR_REFS_FILE, 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def output_bytes(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return None
+
+@contextmanager
+def collect(records=None):
+    """Gather the spans finished on this thread inside the block into records, which is returned"""
+    records = [] if records is None else records
+    collectors = _stack('collectors')
+    collectors.append(records)
+    try:
+        yield records
+    finally:
+        collectors.pop()
+
+def record(records):
+    """Add spans finished elsewhere, such as in a worker process, to the innermost collector
+
+    Top-level spans among them become children of the span open on this thread.
+    """
+    open_spans = _stack('spans')
+    if open_spans:
+        for finished in records:
+            if finished['parent'] is None:
+                finished['parent'] = open_spans[-1]['name']
+    collectors = _stack('collectors')
+    if collectors:
+        collectors[-1].extend(records)
+
+@contextmanager
+def span(name, output=None):
+    """Measure a block as a span, logging it and adding it to the innermost collector
+
+    A span records its wall and CPU time, the peak RSS of the process while it
+    ran and, when output names a file, the size of that file afterwards. CPU
+    time is that of the current thread; peak RSS covers the whole process, so
+    spans running concurrently on other threads of it are included. The block
+    may set 'output' on the yielded dict once it knows the file it wrote.
+    """
+    open_spans = _stack('spans')
+    parent = open_spans[-1] if open_spans else None
+    if parent is not None:
+        parent['child_peak'] = max(parent['child_peak'], peak_rss_bytes())
+    current = {'name': name, 'child_peak': 0}
+    open_spans.append(current)
+
+    reset_peak_rss()
+    wall, cpu = time.perf_counter(), time.thread_time()
+    status = 'done'
+    try:
+        yield current
+    except BaseException:
+        status = 'failed'
+        raise
+    finally:
+        peak = max(peak_rss_bytes(), current['child_peak'])
+        open_spans.pop()
+        if parent is not None:
+            parent['child_peak'] = max(parent['child_peak'], peak)
+        finished = {
+            'name': name,
+            'parent': parent['name'] if parent is not None else None,
+            'status': status,
+            'wall_seconds': round(time.perf_counter() - wall, 6),
+            'cpu_seconds': round(time.thread_time() - cpu, 6),
+            'peak_rss_bytes': peak,
+            'output_bytes': output_bytes(current.get('output', output)),
+            'pid': os.getpid()
+        }
+        print(f"{LOG_PREFIX} {json.dumps(finished)}")
+        record([finished])
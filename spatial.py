@@ -0,0 +1,67 @@
+import os
+import pickle
+import numpy as np
+from workspaces import atomic_write
+
+# Mean Earth radius used to turn distances on the unit sphere into kilometres
+EARTH_RADIUS_KM = 6371.0088
+
+# File the pickled tree is stored under in a compiled census cache directory
+TREE_FILE = 'places_kdtree.pickle'
+
+def unit_vectors(lat, lng):
+    """Return 3D points on the unit sphere for coordinates in degrees
+
+    Straight-line (chord) distances between these points grow monotonically
+    with great-circle distance, so a Euclidean KD-tree finds the nearest
+    places correctly everywhere, including across the antimeridian.
+    """
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lng = np.radians(np.asarray(lng, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.stack([cos_lat * np.cos(lng), cos_lat * np.sin(lng), np.sin(lat)], axis=-1)
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(np.asarray(chord) / 2, 0, 1))
+
+def km_to_chord(km):
+    return 2 * np.sin(np.minimum(np.asarray(km, dtype=np.float64) / EARTH_RADIUS_KM, np.pi) / 2)
+
+def build_tree(lat, lng):
+    from scipy.spatial import cKDTree
+    return cKDTree(unit_vectors(lat, lng))
+
+def save_tree(tree, cache_dir):
+    atomic_write(os.path.join(cache_dir, TREE_FILE), pickle.dumps(tree, protocol=pickle.HIGHEST_PROTOCOL))
+
+def load_tree(cache_dir):
+    """Return the tree stored in a census cache directory, or None if there is none"""
+    try:
+        with open(os.path.join(cache_dir, TREE_FILE), 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+
+class PlaceIndex:
+    """Nearest-place and radius queries over census coordinates, backed by a cKDTree"""
+
+    def __init__(self, tree):
+        self.tree = tree
+
+    def nearest(self, lat, lng, k=1):
+        """Return the rows of the k places nearest each point and their distances in km
+
+        Both results have shape (points, k); with fewer than k places, missing
+        rows are -1 and their distances infinite.
+        """
+        chords, rows = self.tree.query(unit_vectors(np.atleast_1d(lat), np.atleast_1d(lng)), k=[*range(1, k + 1)])
+        found = rows < self.tree.n
+        return np.where(found, rows, -1), np.where(found, chord_to_km(np.where(found, chords, 0)), np.inf)
+
+    def within(self, lat, lng, radius_km):
+        """Return the rows of every place within radius_km of a point, nearest first, and their distances"""
+        point = unit_vectors(lat, lng)
+        rows = np.asarray(self.tree.query_ball_point(point, km_to_chord(radius_km)), dtype=np.int64)
+        distances = chord_to_km(np.linalg.norm(self.tree.data[rows] - point, axis=1))
+        order = np.argsort(distances, kind='stable')
+        return rows[order], distances[order]
@@ -0,0 +1,175 @@
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Every browser session gets its own directory for uploads and jobs
+WORKSPACE_ROOT = 'workspaces'
+WORKSPACE_COOKIE = 'oncocontour_workspace'
+
+# A workspace's outputs are published in their own directory under a separate
+# random id, so a shared report link never reveals the session's workspace id
+REPORT_ROOT = 'reports'
+REPORT_ID_FILE = 'report_id'
+
+# Workspaces untouched for this long are deleted by the garbage collector
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+GC_INTERVAL_SECONDS = 15 * 60
+
+WORKSPACE_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+_gc_thread = None
+
+def workspace_ttl():
+    """Return how long an idle workspace is kept, in seconds"""
+    return int(os.environ.get('ONCOCONTOUR_WORKSPACE_TTL', DEFAULT_TTL_SECONDS))
+
+def new_workspace_id():
+    return uuid.uuid4().hex
+
+def is_valid_workspace_id(workspace_id):
+    return bool(workspace_id) and bool(WORKSPACE_ID_PATTERN.match(workspace_id))
+
+def workspace_path(workspace_id, *parts, root=WORKSPACE_ROOT):
+    """Return a path inside a workspace; outputs live at its top level"""
+    if not is_valid_workspace_id(workspace_id):
+        raise ValueError(f"Invalid workspace id: {workspace_id!r}")
+    return os.path.join(root, workspace_id, *parts)
+
+def uploads_folder(workspace_id, root=WORKSPACE_ROOT):
+    return workspace_path(workspace_id, 'uploads', root=root)
+
+def jobs_folder(workspace_id, root=WORKSPACE_ROOT):
+    return workspace_path(workspace_id, 'jobs', root=root)
+
+def _read_report_id(workspace_id, root=WORKSPACE_ROOT):
+    try:
+        with open(workspace_path(workspace_id, REPORT_ID_FILE, root=root)) as f:
+            report_id = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return report_id if is_valid_workspace_id(report_id) else None
+
+def report_id(workspace_id, root=WORKSPACE_ROOT):
+    """Return the id a workspace's outputs are published under, choosing it on first use"""
+    existing = _read_report_id(workspace_id, root=root)
+    if existing:
+        return existing
+    path = workspace_path(workspace_id, REPORT_ID_FILE, root=root)
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, 'w') as f:
+        f.write(new_workspace_id())
+    try:
+        # Linking fails if a concurrent request chose an id first, and then its id is used
+        os.link(temp_path, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.unlink(temp_path)
+    return _read_report_id(workspace_id, root=root)
+
+def output_folder(workspace_id, root=WORKSPACE_ROOT, report_root=REPORT_ROOT):
+    """Return the directory a workspace's outputs are written to, creating it if needed"""
+    path = os.path.join(report_root, report_id(workspace_id, root=root))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def output_path(workspace_id, filename, root=WORKSPACE_ROOT, report_root=REPORT_ROOT):
+    return os.path.join(output_folder(workspace_id, root=root, report_root=report_root), filename)
+
+def output_url(workspace_id, filename, root=WORKSPACE_ROOT):
+    """Return the URL an output file of a workspace is served from"""
+    return f"/{REPORT_ROOT}/{report_id(workspace_id, root=root)}/{filename}"
+
+def is_output_path(path):
+    """Tell whether a relative URL path names a file published at the top level of a report folder"""
+    parts = path.split('/')
+    return len(parts) == 3 and parts[0] == REPORT_ROOT and is_valid_workspace_id(parts[1])
+
+def ensure_workspace(workspace_id, root=WORKSPACE_ROOT):
+    """Create the workspace directories if needed and mark the workspace as active"""
+    path = workspace_path(workspace_id, root=root)
+    os.makedirs(uploads_folder(workspace_id, root=root), exist_ok=True)
+    os.makedirs(jobs_folder(workspace_id, root=root), exist_ok=True)
+    os.utime(path)
+    return path
+
+@contextmanager
+def atomic_output(path):
+    """Yield a temporary path to write to, then rename it over path in one step
+
+    Readers see either the previous file or the complete new one, never a
+    partially written file. The temporary file is removed if writing fails.
+    """
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+
+def atomic_write(path, data):
+    """Atomically replace path with data (str or bytes)"""
+    mode = 'wb' if isinstance(data, bytes) else 'w'
+    with atomic_output(path) as temp_path:
+        with open(temp_path, mode) as f:
+            f.write(data)
+
+def collect_garbage(root=WORKSPACE_ROOT, max_age=None, report_root=REPORT_ROOT):
+    """Delete workspaces that have not been used within max_age seconds, with their reports
+
+    Report folders whose workspace no longer exists are deleted once they
+    are as old as max_age too.
+    """
+    if max_age is None:
+        max_age = workspace_ttl()
+    if not os.path.isdir(root):
+        return []
+
+    cutoff = time.time() - max_age
+    removed = []
+    live_reports = set()
+    for entry in os.scandir(root):
+        if not entry.is_dir() or not is_valid_workspace_id(entry.name):
+            continue
+        try:
+            if entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path)
+                removed.append(entry.name)
+            else:
+                live_reports.add(_read_report_id(entry.name, root=root))
+        except OSError as e:
+            print(f"Error removing workspace {entry.path}: {e}")
+
+    if os.path.isdir(report_root):
+        for entry in os.scandir(report_root):
+            if entry.name in live_reports or not entry.is_dir():
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    shutil.rmtree(entry.path)
+            except OSError as e:
+                print(f"Error removing report folder {entry.path}: {e}")
+    return removed
+
+def start_garbage_collector(root=WORKSPACE_ROOT, interval=GC_INTERVAL_SECONDS):
+    """Start a daemon thread that periodically deletes idle workspaces"""
+    global _gc_thread
+    if _gc_thread is not None and _gc_thread.is_alive():
+        return _gc_thread
+
+    def run():
+        while True:
+            try:
+                collect_garbage(root)
+            except Exception as e:
+                print(f"Error collecting workspaces: {e}")
+            time.sleep(interval)
+
+    _gc_thread = threading.Thread(target=run, name='workspace-gc', daemon=True)
+    _gc_thread.start()
+    return _gc_thread